@@ -0,0 +1,301 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Detect number plates in large numbers of images.
+
+Images are decoded by a pool of worker threads (or processes), and passed to
+the detector in batches, so that decoding overlaps with detection. Results are
+written as JSON lines, one per image, of the form:
+
+    {"path": "in.jpg", "plates": [{"bbox": [...], "present_prob": ...,
+                                   "code": "..."}, ...]}
+
+Images which cannot be read are given an `"error"` key in place of `"plates"`.
+
+The output file is flushed after each batch. If it already exists, the images
+listed in it are skipped and new lines are appended, so an interrupted run can
+be resumed by repeating the same command.
+
+"""
+
+
+__all__ = (
+    'common_dir',
+    'expand_inputs',
+    'process_batch',
+    'read_done',
+)
+
+
+import collections
+import glob
+import itertools
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import sys
+import time
+
+import cv2
+import numpy
+
+import detect
+
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff')
+
+
+def expand_inputs(spec):
+    """
+    Expand an input specification into a list of image paths.
+
+    :param spec:
+        One of:
+          - `@list.txt`: A file containing one image path per line.
+          - A directory: All images directly within the directory.
+          - Otherwise a glob pattern.
+
+    """
+    if spec.startswith("@"):
+        with open(spec[1:]) as f:
+            return [line.strip() for line in f if line.strip()]
+    elif os.path.isdir(spec):
+        return sorted(os.path.join(spec, fname)
+                      for fname in os.listdir(spec)
+                      if os.path.splitext(fname)[1].lower() in
+                                                            IMAGE_EXTENSIONS)
+    else:
+        return sorted(glob.glob(spec))
+
+
+def read_done(out_fname):
+    """
+    Read the paths of the images already recorded in an output file.
+
+    A trailing partial line, as left by an interrupted run, is removed from
+    the file so that new lines can be appended. A final line without a
+    newline counts as partial, even if it happens to be valid JSON.
+
+    :returns:
+        Set of paths.
+
+    """
+    done = set()
+    if not os.path.exists(out_fname):
+        return done
+
+    good_size = 0
+    with open(out_fname, "rb") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            try:
+                done.add(json.loads(line)['path'])
+            except ValueError:
+                break
+            good_size += len(line)
+    if good_size != os.path.getsize(out_fname):
+        with open(out_fname, "r+b") as f:
+            f.truncate(good_size)
+
+    return done
+
+
+def _load(fname, keep_color):
+    # Runs in a worker. Returns the grayscale image scaled to [0, 1], and the
+    # color image if it is needed for annotation.
+    im = cv2.imread(fname)
+    if im is None:
+        return None, None
+    im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY).astype(numpy.float32)
+    im_gray /= 255.
+    return im_gray, im if keep_color else None
+
+
+def _iter_loaded(pool, fnames, keep_color, max_pending):
+    # Decode images in `pool`, yielding them in order, with at most
+    # `max_pending` decoded or decoding at once.
+    pending = collections.deque()
+    for fname in fnames:
+        pending.append((fname, pool.apply_async(_load, (fname, keep_color))))
+        if len(pending) >= max_pending:
+            fname, result = pending.popleft()
+            yield (fname,) + result.get()
+    while pending:
+        fname, result = pending.popleft()
+        yield (fname,) + result.get()
+
+
+def common_dir(fnames):
+    """
+    Find the deepest directory containing all of the given paths.
+
+    """
+    dirs = [os.path.abspath(os.path.dirname(fname)).split(os.sep)
+                for fname in fnames]
+    return os.sep.join(os.path.commonprefix(dirs)) or os.sep
+
+
+def _annotated_fname(annotate_dir, annotate_root, fname):
+    # Mirror the image's path relative to `annotate_root` under
+    # `annotate_dir`, so that images with the same base name in different
+    # directories do not collide.
+    out_fname = os.path.join(annotate_dir,
+                             os.path.relpath(os.path.abspath(fname),
+                                             annotate_root))
+    out_dir = os.path.dirname(out_fname)
+    if not os.path.isdir(out_dir):
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            if not os.path.isdir(out_dir):
+                raise
+    return out_fname
+
+
+def process_batch(detector, fnames, out_file, batch_size=8, workers=4,
+                  processes=False, annotate_dir=None, annotate_root=None,
+                  strategy='intersect', iou_threshold=0.5):
+    """
+    Detect number plates in a sequence of images.
+
+    :param detector:
+        `detect.Detector` to use.
+
+    :param fnames:
+        Paths of the images to process.
+
+    :param out_file:
+        File object to write JSON lines to.
+
+    :param batch_size:
+        Number of images to pass to the detector at once.
+
+    :param workers:
+        Number of workers decoding images.
+
+    :param processes:
+        If true the workers are processes, otherwise threads.
+
+    :param annotate_dir:
+        (Optional.) Directory to write annotated copies of the images to,
+        under their paths relative to `annotate_root`.
+
+    :param annotate_root:
+        (Optional.) Directory that the paths of annotated images are relative
+        to. By default this is `common_dir(fnames)`.
+
+    :param strategy:
+        Passed to `detect.post_process`.
+
+    :param iou_threshold:
+        Passed to `detect.post_process`.
+
+    :returns:
+        The number of images processed.
+
+    """
+    if annotate_dir is not None and annotate_root is None:
+        fnames = list(fnames)
+        annotate_root = common_dir(fnames)
+
+    if processes:
+        pool = multiprocessing.Pool(workers)
+    else:
+        pool = multiprocessing.pool.ThreadPool(workers)
+
+    count = 0
+    reported_shapes = set()
+    try:
+        loaded = _iter_loaded(pool, fnames, annotate_dir is not None,
+                              max_pending=2 * max(batch_size, workers))
+        while True:
+            # Time spent here is time spent waiting for the workers to decode
+            # images.
+            with detector.profiler.stage("read"):
+                batch = list(itertools.islice(loaded, batch_size))
+            detector.profiler.count("read", len(batch))
+            if not batch:
+                break
+
+            readable = [item for item in batch if item[1] is not None]
+            for _, im, _ in readable:
+                if im.shape not in reported_shapes:
+                    reported_shapes.add(im.shape)
+                    print >>sys.stderr, "{}x{}: {}".format(
+                            im.shape[1], im.shape[0],
+                            detect.format_pyramid_work(
+                                detector.pyramid_work(im.shape)))
+            all_matches = detector.find_matches([im for _, im, _ in readable])
+            plates = {}
+            for (fname, _, im), matches in zip(readable, all_matches):
+                plates[fname] = list(detector.post_process(
+                                                matches,
+                                                strategy=strategy,
+                                                iou_threshold=iou_threshold))
+                if annotate_dir is not None:
+                    with detector.profiler.stage("annotate"):
+                        detect.annotate(im, plates[fname])
+                        cv2.imwrite(_annotated_fname(annotate_dir,
+                                                     annotate_root, fname),
+                                    im)
+
+            for fname, _, _ in batch:
+                if fname in plates:
+                    record = dict(path=fname,
+                                  plates=[detect.match_to_dict(*m)
+                                              for m in plates[fname]])
+                else:
+                    record = dict(path=fname, error="Could not read image")
+                out_file.write(json.dumps(record) + "\n")
+            out_file.flush()
+            count += len(batch)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return count
+
+
+def main(spec, detector, out_fname, batch_size=8, workers=4, processes=False,
+         annotate_dir=None):
+    fnames = expand_inputs(spec)
+    done = read_done(out_fname)
+    todo = [fname for fname in fnames if fname not in done]
+    print >>sys.stderr, "{} images, {} already done".format(
+                            len(fnames), len(fnames) - len(todo))
+
+    if annotate_dir is not None and not os.path.isdir(annotate_dir):
+        os.makedirs(annotate_dir)
+
+    start = time.time()
+    with open(out_fname, "ab") as out_file:
+        count = process_batch(detector, todo, out_file,
+                              batch_size=batch_size,
+                              workers=workers,
+                              processes=processes,
+                              annotate_dir=annotate_dir,
+                              annotate_root=common_dir(fnames))
+    elapsed = time.time() - start
+    print >>sys.stderr, "processed: {} time: {:.1f}s images/s: {:.2f}".format(
+                            count, elapsed, count / max(elapsed, 1e-6))
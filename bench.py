@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Benchmarks for number plate detection.
+
+`search` compares the coarse-to-fine search of
+`detect.Detector.find_matches_coarse_to_fine` with the exhaustive search of
+`detect.Detector.find_matches`, in terms of speed and recall.
+
+`startup` measures the time taken by a fresh process to detect plates in its
+first image, with each of the `detect.Detector` backends.
+
+`suite` measures the latency, throughput and peak memory use of detection
+(including post-processing) on synthetic scenes at a range of resolutions. The
+scenes are made by compositing plates from `gen.generate_plate` onto images
+from `bgs/`, from a fixed seed, so that results are comparable between runs.
+Results are written as JSON, and can be checked against a previous run's
+results with `--baseline`.
+
+"""
+
+
+__all__ = (
+    'SCENE_SHAPES',
+    'compare_results',
+    'compare_search',
+    'make_scene',
+    'measure_startup',
+    'random_weights',
+    'run_suite',
+)
+
+
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy
+
+import common
+import detect
+import gen
+import npmodel
+import weightstore
+
+
+def _iou(bboxes, bbox):
+    inter = (numpy.maximum(0, numpy.minimum(bboxes[:, 2], bbox[2]) -
+                              numpy.maximum(bboxes[:, 0], bbox[0])) *
+             numpy.maximum(0, numpy.minimum(bboxes[:, 3], bbox[3]) -
+                              numpy.maximum(bboxes[:, 1], bbox[1])))
+    areas = ((bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1]) +
+             (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]))
+    return inter / numpy.maximum(areas - inter, 1e-9)
+
+
+def _recalled(bboxes, bbox, min_iou):
+    return len(bboxes) > 0 and numpy.max(_iou(bboxes, bbox)) >= min_iou
+
+
+def compare_search(detector, ims, coarse_levels=3, margin=0.5,
+                   min_coarse_prob=0.5, min_iou=0.5):
+    """
+    Compare coarse-to-fine search with exhaustive search.
+
+    The exhaustive search is taken as the ground truth. A plate found by the
+    exhaustive search counts as recalled if the coarse-to-fine search finds a
+    plate overlapping it with an intersection over union of at least
+    `min_iou`.
+
+    :param detector:
+        `detect.Detector` to use.
+
+    :param ims:
+        Sequence of grayscale images to search.
+
+    :returns:
+        Dict of results, giving the total time taken by each search, the
+        number of windows and plates found by each, and the fraction of the
+        exhaustive search's windows and plates recalled.
+
+    """
+    results = dict(exhaustive_time=0.,
+                   coarse_to_fine_time=0.,
+                   exhaustive_windows=0,
+                   coarse_to_fine_windows=0,
+                   exhaustive_plates=0,
+                   coarse_to_fine_plates=0,
+                   recalled_plates=0)
+
+    for im in ims:
+        start = time.time()
+        exhaustive = detector.find_matches([im])[0]
+        exhaustive_plates = detect.group_matches(exhaustive)
+        results['exhaustive_time'] += time.time() - start
+
+        start = time.time()
+        coarse_to_fine = detector.find_matches_coarse_to_fine(
+                                im,
+                                coarse_levels=coarse_levels,
+                                margin=margin,
+                                min_coarse_prob=min_coarse_prob)
+        coarse_to_fine_plates = detect.group_matches(coarse_to_fine)
+        results['coarse_to_fine_time'] += time.time() - start
+
+        results['exhaustive_windows'] += len(exhaustive.bboxes)
+        results['coarse_to_fine_windows'] += len(coarse_to_fine.bboxes)
+        results['exhaustive_plates'] += len(exhaustive_plates.bboxes)
+        results['coarse_to_fine_plates'] += len(coarse_to_fine_plates.bboxes)
+        for bbox in exhaustive_plates.bboxes:
+            if _recalled(coarse_to_fine_plates.bboxes, bbox, min_iou):
+                results['recalled_plates'] += 1
+
+    # The coarse-to-fine search evaluates a subset of the exhaustive search's
+    # windows, with identical results, so the window counts give the recall
+    # of individual windows.
+    results['window_recall'] = (
+        float(results['coarse_to_fine_windows']) /
+        max(1, results['exhaustive_windows']))
+    results['plate_recall'] = (float(results['recalled_plates']) /
+                               max(1, results['exhaustive_plates']))
+    results['speedup'] = (results['exhaustive_time'] /
+                          max(1e-9, results['coarse_to_fine_time']))
+
+    return results
+
+
+# Run by `measure_startup` in a fresh interpreter. Prints the time taken to
+# import `detect`, load the weights, construct the detector and search the
+# first image.
+_STARTUP_SCRIPT = """
+import sys, time
+start = time.time()
+import numpy
+import detect
+import weightstore
+imported = time.time()
+param_vals = weightstore.load_weights(sys.argv[1])
+loaded = time.time()
+with detect.Detector(param_vals, backend=sys.argv[2]) as detector:
+    constructed = time.time()
+    detector.find_matches([numpy.zeros((int(sys.argv[3]), int(sys.argv[4])))])
+    detected = time.time()
+print imported - start, loaded - imported, constructed - loaded, \\
+      detected - constructed
+"""
+
+
+def measure_startup(weights_fname, backend, im_shape=(64, 128)):
+    """
+    Measure the cold start time of a detector.
+
+    A new Python process is started which constructs a `detect.Detector`
+    and searches a single image.
+
+    :param weights_fname:
+        Weights file to load.
+
+    :param backend:
+        Backend to pass to `detect.Detector`.
+
+    :param im_shape:
+        Shape of the image to search. By default this is a single window.
+
+    :returns:
+        Dict giving the total time taken by the process, and the time taken
+        to import `detect`, load the weights, construct the detector, and
+        search the image.
+
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+                            [os.path.dirname(os.path.abspath(__file__))] +
+                            env.get('PYTHONPATH', '').split(os.pathsep))
+    start = time.time()
+    out = subprocess.check_output([sys.executable, "-c", _STARTUP_SCRIPT,
+                                   weights_fname, backend,
+                                   str(im_shape[0]), str(im_shape[1])],
+                                  env=env)
+    total = time.time() - start
+
+    times = [float(t) for t in out.split()[-4:]]
+    return dict(zip(('import_time', 'load_time', 'construct_time',
+                     'detect_time'), times),
+                total_time=total)
+
+
+# Shapes of the scenes searched by `run_suite`, by name.
+SCENE_SHAPES = {
+    '480p': (480, 854),
+    '720p': (720, 1280),
+    '1080p': (1080, 1920),
+    '4k': (2160, 3840),
+}
+
+
+def random_weights(ims, seed=0, pass_fraction=0.01):
+    """
+    Make random model parameters, for benchmarking when no trained weights
+    are available.
+
+    The parameters have the shapes of those output by `train.train`. Weights
+    are scaled by the square root of their fan in, so that activations stay
+    within the range seen with trained weights. The presence output is then
+    rescaled and offset so that about `pass_fraction` of the windows in `ims`
+    exceed the detection threshold, so that decoding and post-processing are
+    exercised as with trained weights.
+
+    :param ims:
+        Grayscale images to calibrate the presence output with, such as the
+        scenes to be benchmarked. Every window of each image is used.
+
+    :param seed:
+        Seed for the random weights.
+
+    :param pass_fraction:
+        Fraction of windows which should be detected.
+
+    """
+    rs = numpy.random.RandomState(seed)
+    shapes = [(5, 5, 1, 48), (5, 5, 48, 64), (5, 5, 64, 128),
+              (32 * 8 * 128, 2048), (2048, 1 + 7 * len(common.CHARS))]
+    param_vals = []
+    for shape in shapes:
+        fan_in = numpy.prod(shape[:-1])
+        param_vals.append((rs.randn(*shape) /
+                           numpy.sqrt(fan_in)).astype(numpy.float32))
+        param_vals.append(numpy.zeros(shape[-1:], dtype=numpy.float32))
+
+    # With zero biases the presence logits are close to zero, far below the
+    # threshold, so no windows would be detected. Spread the logits to a
+    # standard deviation of 2, and place the threshold (that of
+    # `detect.Detector`, a 99% presence probability) at the `1 -
+    # pass_fraction` quantile.
+    layers = npmodel.detect_layers(param_vals)
+    logits = numpy.concatenate([
+                npmodel.forward(im[numpy.newaxis], layers)[..., 0].ravel()
+                for im in ims])
+    gain = 2. / max(numpy.std(logits), 1e-12)
+    param_vals[8][:, 0] *= gain
+    param_vals[9][0] = (-math.log(1. / 0.99 - 1) -
+                        gain * numpy.percentile(logits,
+                                                100. * (1 - pass_fraction)))
+    return param_vals
+
+
+def _load_bgs(bg_dir, max_bgs=20):
+    # Grayscale background images, or an empty list if there are none.
+    if not os.path.isdir(bg_dir):
+        return []
+    bgs = []
+    for fname in sorted(os.listdir(bg_dir))[:max_bgs]:
+        bg = cv2.imread(os.path.join(bg_dir, fname),
+                        cv2.CV_LOAD_IMAGE_GRAYSCALE)
+        if bg is not None:
+            bgs.append(bg / 255.)
+    return bgs
+
+
+def make_scene(shape, char_ims, bgs, num_plates=3):
+    """
+    Composite number plates onto a background.
+
+    The `random` and `numpy.random` generators are used, so seed both for
+    reproducible scenes.
+
+    :param shape:
+        Shape of the scene.
+
+    :param char_ims:
+        Character images for `gen.generate_plate`.
+
+    :param bgs:
+        List of grayscale background images, one of which is picked and
+        resized to `shape`. If empty, smoothed noise is used.
+
+    :param num_plates:
+        Number of plates to composite. Their widths are chosen uniformly
+        between 5% and 25% of the scene's width.
+
+    :returns:
+        Pair `scene, plates`, where `scene` is a grayscale image with values
+        in `[0, 1]`, and `plates` is a list of `bbox, code` giving the
+        `top, left, bottom, right` bounding box and code of each plate.
+
+    """
+    if bgs:
+        scene = cv2.resize(random.choice(bgs), (shape[1], shape[0]))
+    else:
+        scene = cv2.GaussianBlur(numpy.random.random(shape), (0, 0), 4.)
+        scene = (scene - scene.min()) / max(1e-9, scene.ptp())
+
+    plates = []
+    for _ in range(num_plates):
+        plate, plate_mask, code = gen.generate_plate(gen.FONT_HEIGHT,
+                                                     char_ims)
+        width = int(shape[1] * random.uniform(0.05, 0.25))
+        height = max(1, int(width * plate.shape[0] / plate.shape[1]))
+        plate = cv2.resize(plate, (width, height))
+        plate_mask = cv2.resize(plate_mask, (width, height))
+
+        y = random.randint(0, shape[0] - height)
+        x = random.randint(0, shape[1] - width)
+        region = scene[y:y + height, x:x + width]
+        region[:] = plate * plate_mask + region * (1. - plate_mask)
+        plates.append(((y, x, y + height, x + width), code))
+
+    scene += numpy.random.normal(scale=0.02, size=shape)
+    return numpy.clip(scene, 0., 1.).astype(numpy.float32), plates
+
+
+def _peak_rss_mb():
+    # `ru_maxrss` is in kilobytes on Linux, and bytes on OS X.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024. * 1024. if sys.platform == "darwin" else 1024.)
+
+
+def run_suite(detector, scenes, reps=3):
+    """
+    Benchmark detection on sets of scenes.
+
+    Each scene is first searched individually, `reps` times, giving the
+    latency of `find_matches` followed by `post_process` for a single image.
+    All of the scenes of a resolution are then searched as one batch, giving
+    the throughput. An initial untimed search warms up the detector.
+
+    :param detector:
+        `detect.Detector` to use.
+
+    :param scenes:
+        List of `name, ims` pairs, where `ims` is a list of images with the
+        same shape. Resolutions are benchmarked in the order given.
+
+    :returns:
+        Dict mapping each name to a dict giving the image shape and number of
+        images, latency percentiles and mean in seconds, throughput in images
+        per second, the number of plates found per image, and the peak
+        resident set size of the process so far in megabytes. Since the peak
+        resident set size never decreases, list resolutions in increasing
+        order of size.
+
+    """
+    def search(ims):
+        return [list(detector.post_process(matches))
+                    for matches in detector.find_matches(ims)]
+
+    results = {}
+    for name, ims in scenes:
+        search(ims[:1])
+
+        latencies = []
+        plates = 0
+        for _ in range(reps):
+            for im in ims:
+                start = time.time()
+                plates += len(search([im])[0])
+                latencies.append(time.time() - start)
+
+        start = time.time()
+        search(ims)
+        batch_time = time.time() - start
+
+        p50, p90, p99 = numpy.percentile(latencies, [50, 90, 99])
+        results[name] = dict(shape=list(ims[0].shape),
+                             images=len(ims),
+                             latency_p50=p50,
+                             latency_p90=p90,
+                             latency_p99=p99,
+                             latency_mean=numpy.mean(latencies),
+                             throughput=len(ims) / batch_time,
+                             plates_per_image=float(plates) / len(latencies),
+                             peak_rss_mb=_peak_rss_mb())
+    return results
+
+
+# Metrics checked by `compare_results`, and whether larger values are better.
+_COMPARED_METRICS = (
+    ('latency_p50', False),
+    ('latency_p90', False),
+    ('latency_p99', False),
+    ('throughput', True),
+    ('peak_rss_mb', False),
+)
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """
+    Compare benchmark results with a baseline.
+
+    :param results:
+        Results returned by `run_suite`.
+
+    :param baseline:
+        Results returned by an earlier call to `run_suite`. Resolutions not
+        present in both are ignored.
+
+    :param tolerance:
+        Fraction by which a metric may be worse than the baseline before it
+        is considered a regression.
+
+    :returns:
+        List of `name, metric, value, baseline_value, change` for each
+        metric compared, where `change` is the relative change from the
+        baseline, and a list of the same for those which regressed.
+
+    """
+    comparisons = []
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        for metric, larger_is_better in _COMPARED_METRICS:
+            value = results[name][metric]
+            baseline_value = baseline[name][metric]
+            change = (value - baseline_value) / max(1e-9, baseline_value)
+            comparison = (name, metric, value, baseline_value, change)
+            comparisons.append(comparison)
+            if (change < -tolerance if larger_is_better
+                    else change > tolerance):
+                regressions.append(comparison)
+    return comparisons, regressions
+
+
+def _parse_resolution(s):
+    # A name from `SCENE_SHAPES`, or `WIDTHxHEIGHT`.
+    if s.lower() in SCENE_SHAPES:
+        return SCENE_SHAPES[s.lower()]
+    width, height = s.lower().split("x")
+    return int(height), int(width)
+
+
+def _load_gray(fname):
+    return cv2.cvtColor(cv2.imread(fname), cv2.COLOR_BGR2GRAY) / 255.
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detection benchmarks.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    search_parser = subparsers.add_parser(
+                        "search",
+                        help="Compare coarse-to-fine with exhaustive search.")
+    search_parser.add_argument("weights", help="Weights file.")
+    search_parser.add_argument("images", nargs="+", help="Images to search.")
+    search_parser.add_argument("--scale-ratio", type=float,
+                               default=1. / 2 ** 0.5)
+    search_parser.add_argument("--coarse-levels", type=int, default=3)
+    search_parser.add_argument("--margin", type=float, default=0.5)
+    search_parser.add_argument("--min-coarse-prob", type=float, default=0.5)
+
+    startup_parser = subparsers.add_parser(
+                        "startup",
+                        help="Measure cold start time of each backend.")
+    startup_parser.add_argument("weights", help="Weights file.")
+    startup_parser.add_argument("--backends", default="tensorflow,numpy",
+                                help="Comma separated backends to measure.")
+
+    suite_parser = subparsers.add_parser(
+                        "suite",
+                        help="Measure latency, throughput and memory use on "
+                             "synthetic scenes.")
+    suite_parser.add_argument("--weights", default="weights.npz",
+                              help="Weights file. If it does not exist, "
+                                   "random weights are used.")
+    suite_parser.add_argument("--resolutions", default="480p,720p,1080p,4k",
+                              help="Comma separated resolutions, each one of "
+                                   "480p, 720p, 1080p and 4k, or "
+                                   "WIDTHxHEIGHT.")
+    suite_parser.add_argument("--scenes", type=int, default=4,
+                              help="Number of scenes per resolution.")
+    suite_parser.add_argument("--reps", type=int, default=3)
+    suite_parser.add_argument("--seed", type=int, default=0)
+    suite_parser.add_argument("--backend", choices=("tensorflow", "numpy"),
+                              default="tensorflow")
+    suite_parser.add_argument("--output",
+                              help="Where to write the results, as JSON.")
+    suite_parser.add_argument("--baseline",
+                              help="Results of an earlier run to compare "
+                                   "with. The exit status is 1 if any "
+                                   "metric regressed.")
+    suite_parser.add_argument("--tolerance", type=float, default=0.1,
+                              help="Fraction by which a metric may be worse "
+                                   "than the baseline.")
+
+    args = parser.parse_args()
+
+    if args.command == "search":
+        param_vals = weightstore.load_weights(args.weights)
+        ims = [_load_gray(fname) for fname in args.images]
+        with detect.Detector(param_vals,
+                             scale_ratio=args.scale_ratio) as detector:
+            results = compare_search(detector, ims,
+                                     coarse_levels=args.coarse_levels,
+                                     margin=args.margin,
+                                     min_coarse_prob=args.min_coarse_prob)
+        for key in sorted(results):
+            print "{:24} {}".format(key, results[key])
+    elif args.command == "startup":
+        print "{:>10} {:>8} {:>8} {:>8} {:>9} {:>8}".format(
+                    "backend", "total", "import", "load", "construct",
+                    "detect")
+        for backend in args.backends.split(","):
+            r = measure_startup(args.weights, backend)
+            print "{:>10} {:8.2f} {:8.2f} {:8.2f} {:9.2f} {:8.2f}".format(
+                        backend, r['total_time'], r['import_time'],
+                        r['load_time'], r['construct_time'], r['detect_time'])
+    elif args.command == "suite":
+        random.seed(args.seed)
+        numpy.random.seed(args.seed)
+        fonts, font_char_ims = gen.load_fonts(gen.FONT_DIR)
+        bgs = _load_bgs("bgs")
+        scenes = []
+        for name in args.resolutions.split(","):
+            shape = _parse_resolution(name)
+            scenes.append((name, [make_scene(shape,
+                                             font_char_ims[random.choice(
+                                                                    fonts)],
+                                             bgs)[0]
+                                      for _ in range(args.scenes)]))
+
+        weights = args.weights
+        if os.path.exists(weights):
+            param_vals = weightstore.load_weights(weights)
+        else:
+            print >>sys.stderr, ("{} does not exist, using random "
+                                 "weights".format(weights))
+            # Calibrate the random weights with one of the smallest scenes.
+            param_vals = random_weights(
+                                [min((ims[0] for name, ims in scenes),
+                                     key=lambda im: im.size)],
+                                args.seed)
+            weights = None
+
+        with detect.Detector(param_vals, backend=args.backend) as detector:
+            results = run_suite(detector, scenes, reps=args.reps)
+
+        print "{:>10} {:>9} {:>9} {:>9} {:>11} {:>9}".format(
+                    "resolution", "p50 (s)", "p90 (s)", "p99 (s)",
+                    "images/s", "RSS (MB)")
+        for name, _ in scenes:
+            r = results[name]
+            print "{:>10} {:9.3f} {:9.3f} {:9.3f} {:11.2f} {:9.0f}".format(
+                        name, r['latency_p50'], r['latency_p90'],
+                        r['latency_p99'], r['throughput'], r['peak_rss_mb'])
+
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(dict(weights=weights,
+                               backend=args.backend,
+                               seed=args.seed,
+                               reps=args.reps,
+                               results=results),
+                          f, indent=2, sort_keys=True)
+
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+            comparisons, regressions = compare_results(results, baseline,
+                                                       args.tolerance)
+            for name, metric, value, baseline_value, change in comparisons:
+                print "{:>10} {:>14} {:10.3f} {:10.3f} {:+7.1f}%{}".format(
+                        name, metric, value, baseline_value, 100. * change,
+                        " REGRESSED" if (name, metric, value, baseline_value,
+                                         change) in regressions else "")
+            if regressions:
+                sys.exit(1)
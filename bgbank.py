@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+A packed, memory-mapped bank of background images.
+
+`gen.generate_bg` reads and decodes a JPEG from `bgs/` for every image it
+generates. A background bank instead holds the decoded grayscale backgrounds,
+so that a background can be cropped straight out of memory.
+
+A bank is a directory containing shard files of raw `uint8` pixels, and an
+`index.npy` giving the shard, byte offset, height and width of each image.
+Shards are memory-mapped when first used, so processes reading the same bank
+share a single copy of it in the page cache. Only images at least as large as
+the crops taken from them by `gen.generate_bg` are kept.
+
+Run this module as a script to build a bank from `bgs/`.
+
+"""
+
+
+__all__ = (
+    'BackgroundBank',
+    'BankWriter',
+    'build_bank',
+    'is_bank',
+)
+
+
+import argparse
+import os
+import random
+
+import cv2
+import numpy
+
+
+INDEX_NAME = "index.npy"
+
+
+def _shard_name(shard):
+    return "{:04d}.u8".format(shard)
+
+
+def is_bank(dirname):
+    """
+    Return whether `dirname` contains a complete, non-empty background bank.
+
+    """
+    index_fname = os.path.join(dirname, INDEX_NAME)
+    return (os.path.isfile(index_fname) and
+            len(numpy.load(index_fname, mmap_mode='r')) > 0)
+
+
+class BankWriter(object):
+    """
+    Write images to a new background bank.
+
+    The index is written by `flush` and `close`, after the shards, so an
+    interrupted write does not leave behind something which looks like a
+    valid bank, beyond the images written before the last flush. When used
+    as a context manager, the index is only written if no exception was
+    raised.
+
+    """
+
+    def __init__(self, dirname, max_shard_bytes=1 << 30, keep=0):
+        """
+        :param dirname:
+            Directory to write the bank to. It is created if it doesn't exist.
+
+        :param max_shard_bytes:
+            Size above which a new shard is started.
+
+        :param keep:
+            Number of images of an existing bank in `dirname` to keep, for
+            resuming an interrupted write. Anything written after these
+            images is discarded, and new images are appended after them.
+
+        """
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        index_fname = os.path.join(dirname, INDEX_NAME)
+
+        self.dirname = dirname
+        self.max_shard_bytes = max_shard_bytes
+        self._entries = []
+        self._shard = -1
+        self._offset = 0
+        self._f = None
+
+        if keep:
+            self._entries = [tuple(int(v) for v in entry)
+                                 for entry in numpy.load(index_fname)[:keep]]
+            if len(self._entries) != keep:
+                raise ValueError("{} has {} images, fewer than the {} to "
+                                 "keep".format(dirname, len(self._entries),
+                                               keep))
+            shard, offset, height, width = self._entries[-1]
+            self._shard = shard
+            self._offset = offset + height * width
+            self._f = open(os.path.join(dirname, _shard_name(shard)), "r+b")
+            self._f.truncate(self._offset)
+            self._f.seek(self._offset)
+        elif os.path.exists(index_fname):
+            os.remove(index_fname)
+
+        # Remove any shards after the current one.
+        shard = self._shard + 1
+        while os.path.exists(os.path.join(dirname, _shard_name(shard))):
+            os.remove(os.path.join(dirname, _shard_name(shard)))
+            shard += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, im):
+        """
+        Append a 2D `uint8` image to the bank.
+
+        """
+        im = numpy.ascontiguousarray(im, dtype=numpy.uint8)
+        if self._f is None or (self._offset > 0 and
+                               self._offset + im.nbytes >
+                                                self.max_shard_bytes):
+            self._next_shard()
+        self._f.write(im.tostring())
+        self._entries.append((self._shard, self._offset) + im.shape)
+        self._offset += im.nbytes
+
+    def _next_shard(self):
+        if self._f is not None:
+            self._f.close()
+        self._shard += 1
+        self._offset = 0
+        self._f = open(os.path.join(self.dirname,
+                                    _shard_name(self._shard)), "wb")
+
+    def flush(self):
+        """
+        Write out the images added so far, and an index of them.
+
+        """
+        if self._f is not None:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        self._write_index()
+
+    def close(self):
+        """
+        Finish the last shard and write the index.
+
+        """
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        self._write_index()
+
+    def _write_index(self):
+        index_fname = os.path.join(self.dirname, INDEX_NAME)
+        tmp_fname = index_fname + ".tmp"
+        with open(tmp_fname, "wb") as f:
+            numpy.save(f, numpy.array(self._entries,
+                                      dtype=numpy.int64).reshape(-1, 4))
+        os.rename(tmp_fname, index_fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._f is not None:
+            self._f.close()
+
+
+class BackgroundBank(object):
+    """
+    Read-only access to a background bank.
+
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.index = numpy.load(os.path.join(dirname, INDEX_NAME))
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        """
+        Return image `idx`, as a read-only view of the bank.
+
+        """
+        shard, offset, height, width = self.index[idx]
+        return self._get_shard(shard)[offset:offset + height * width].reshape(
+                                                                height, width)
+
+    def _get_shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = numpy.memmap(
+                                    os.path.join(self.dirname,
+                                                 _shard_name(shard)),
+                                    dtype=numpy.uint8, mode='r')
+        return self._shards[shard]
+
+    def random_crop(self, shape):
+        """
+        Crop a region of the given shape from a random image, using the
+        `random` module.
+
+        :returns:
+            A read-only `uint8` view of the bank.
+
+        """
+        # Images and crop positions are chosen uniformly, as in
+        # `gen.generate_bg`, so the crops have the same distribution. The
+        # crops themselves differ for the same seed, since the bank leaves
+        # out small images which `gen.generate_bg` would draw and reject.
+        im = self[random.randint(0, len(self) - 1)]
+        x = random.randint(0, im.shape[1] - shape[1])
+        y = random.randint(0, im.shape[0] - shape[0])
+        return im[y:y + shape[0], x:x + shape[1]]
+
+
+def build_bank(bg_dir, bank_dir, min_shape=None, max_shard_bytes=1 << 30):
+    """
+    Build a background bank from a directory of images.
+
+    :param bg_dir:
+        Directory of images, such as `bgs/` as written by `extractbgs.py`.
+
+    :param bank_dir:
+        Directory to write the bank to.
+
+    :param min_shape:
+        Images smaller than this in either dimension are left out. Defaults
+        to `gen.OUTPUT_SHAPE`, the shape of the crops `gen` takes.
+
+    :param max_shard_bytes:
+        See `BankWriter`.
+
+    :returns:
+        The number of images added to the bank, and the number left out
+        because they were too small or could not be read.
+
+    :raises ValueError:
+        If no images were added.
+
+    """
+    if min_shape is None:
+        # Imported here since `gen` imports this module.
+        import gen
+        min_shape = gen.OUTPUT_SHAPE
+
+    skipped = 0
+    with BankWriter(bank_dir, max_shard_bytes) as writer:
+        for fname in sorted(os.listdir(bg_dir)):
+            im = cv2.imread(os.path.join(bg_dir, fname),
+                            cv2.CV_LOAD_IMAGE_GRAYSCALE)
+            if (im is None or
+                    im.shape[0] < min_shape[0] or im.shape[1] < min_shape[1]):
+                skipped += 1
+                continue
+            writer.add(im)
+    if len(writer) == 0:
+        raise ValueError("No images in {} are at least {}x{}".format(
+                                        bg_dir, min_shape[1], min_shape[0]))
+    return len(writer), skipped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                description="Build a background bank from a directory of "
+                            "background images.")
+    parser.add_argument("bg_dir", nargs="?", default="bgs",
+                        help="Directory of background images.")
+    parser.add_argument("bank_dir", nargs="?", default="bgbank",
+                        help="Where to write the bank.")
+    parser.add_argument("--shard-size", type=int, default=1024,
+                        help="Maximum size of each shard, in megabytes.")
+    args = parser.parse_args()
+
+    added, skipped = build_bank(args.bg_dir, args.bank_dir,
+                                max_shard_bytes=args.shard_size << 20)
+    print "{} images added, {} skipped".format(added, skipped)
@@ -27,10 +27,19 @@ __all__ = (
     'DIGITS',
     'LETTERS',
     'CHARS',
+    'WINDOW_SHAPE',
+    'PLATE_SCALE_RANGE',
+    'NULL_PROFILER',
+    'Profiler',
+    'fc_ranks',
     'sigmoid',
     'softmax',
 )
 
+import collections
+import json
+import time
+
 import numpy
 
 
@@ -38,9 +47,168 @@ DIGITS = "0123456789"
 LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 CHARS = LETTERS + DIGITS
 
+WINDOW_SHAPE = (64, 128)
+
+# Range of plate widths, as a fraction of the window width, which the model is
+# trained to report as present. See `gen.generate_im`.
+PLATE_SCALE_RANGE = (0.6, 0.875)
+
+def fc_ranks(param_vals):
+    """
+    Infer the ranks of the fully connected layers from a set of parameters.
+
+    Returns `fc1_rank, fc2_rank`, suitable for passing to the `get_*_model`
+    functions in `model` in order to build a model which `param_vals` can be
+    loaded into. Each rank is `None` if the corresponding layer is not
+    factorized.
+
+    """
+    shapes = [p.shape for p in param_vals[6:]]
+    ranks = []
+    for _ in range(2):
+        if len(shapes) > 1 and len(shapes[1]) == 2:
+            ranks.append(shapes[0][1])
+            shapes = shapes[3:]
+        else:
+            ranks.append(None)
+            shapes = shapes[2:]
+    return tuple(ranks)
+
+class _Timer(object):
+    def __init__(self, stat):
+        self._stat = stat
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stat[0] += 1
+        self._stat[1] += time.time() - self._start
+
+
+class Profiler(object):
+    """
+    Record the wall time spent in, and the number of items produced by, named
+    stages of a computation.
+
+    Stages may optionally be qualified with a scale (ie. a pyramid level), so
+    that per-scale costs can be told apart. For example:
+
+        with profiler.stage("run", scale=2):
+            ...
+        profiler.count("decode", len(matches), scale=2)
+
+    Stages should not be nested, since `format_table` assumes that they are
+    disjoint. A profiler is not thread-safe, so should only be used by one
+    thread.
+
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Maps `(name, scale)` to `[calls, seconds, items]`.
+        self._stats = collections.OrderedDict()
+
+    def _stat(self, name, scale):
+        key = (name, scale)
+        if key not in self._stats:
+            self._stats[key] = [0, 0., 0]
+        return self._stats[key]
+
+    def stage(self, name, scale=None):
+        """
+        Return a context manager which times one call of a stage.
+
+        """
+        return _Timer(self._stat(name, scale))
+
+    def count(self, name, n, scale=None):
+        """
+        Add `n` to the number of items produced by a stage.
+
+        """
+        self._stat(name, scale)[2] += n
+
+    def merge(self, records):
+        """
+        Add records, as returned by `records`, to those of this profiler. For
+        example, to combine the results of profilers in several processes.
+
+        """
+        for r in records:
+            stat = self._stat(r['stage'], r['scale'])
+            stat[0] += r['calls']
+            stat[1] += r['seconds']
+            stat[2] += r['items']
+
+    def records(self):
+        """
+        Return a list of dicts, one per stage and scale in the order first
+        seen, with keys `stage`, `scale`, `calls`, `seconds` and `items`.
+
+        """
+        return [dict(stage=name, scale=scale, calls=calls, seconds=seconds,
+                     items=items)
+                    for (name, scale), (calls, seconds, items)
+                        in self._stats.items()]
+
+    def to_json(self):
+        return json.dumps(self.records())
+
+    def format_table(self):
+        """
+        Summarize the recorded stages as a table, with the percentage of the
+        total time spent in each.
+
+        """
+        records = self.records()
+        total = sum(r['seconds'] for r in records) or 1.
+        lines = ["{:<14} {:>5} {:>7} {:>10} {:>10} {:>6} {:>8}".format(
+                    "stage", "scale", "calls", "total (ms)", "mean (ms)", "%",
+                    "items")]
+        for r in records:
+            lines.append(
+                "{:<14} {:>5} {:>7} {:10.2f} {:10.3f} {:6.1f} {:>8}".format(
+                    r['stage'],
+                    "-" if r['scale'] is None else r['scale'],
+                    r['calls'],
+                    1000. * r['seconds'],
+                    1000. * r['seconds'] / max(1, r['calls']),
+                    100. * r['seconds'] / total,
+                    r['items']))
+        return "\n".join(lines)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class _NullProfiler(object):
+    # Stands in for a `Profiler` when profiling is disabled, so that
+    # instrumented code needs no conditionals, and costs only a method call
+    # per stage.
+    _timer = _NullTimer()
+
+    def stage(self, name, scale=None):
+        return self._timer
+
+    def count(self, name, n, scale=None):
+        pass
+
+
+# Profiler which records nothing.
+NULL_PROFILER = _NullProfiler()
+
 def softmax(a):
     exps = numpy.exp(a.astype(numpy.float64))
-    return exps / numpy.sum(exps, axis=-1)[:, numpy.newaxis]
+    return exps / numpy.sum(exps, axis=-1, keepdims=True)
 
 def sigmoid(a):
   return 1. / (1. + numpy.exp(-a))
@@ -25,45 +25,956 @@
 Routines to detect number plates.
 
 Use `detect` to detect all bounding boxes, and use `post_process` on the output
-of `detect` to filter using non-maximum suppression.
+of `detect` to filter using non-maximum suppression. To detect plates in many
+images, construct a `Detector` once and reuse it, to avoid rebuilding the model
+and reloading its weights for every image.
 
 """
 
 
 __all__ = (
+    'Detector',
+    'annotate',
+    'boxes_touching_mask',
+    'Matches',
+    'concatenate_matches',
     'detect',
+    'format_pyramid_work',
+    'group_matches',
+    'iter_matches',
+    'load_rois',
+    'match_to_dict',
+    'plate_width_range',
     'post_process',
+    'pyramid_work',
+    'receptive_fields',
+    'roi_mask',
+    'scaled_shapes',
 )
 
 
+import argparse
 import collections
 import itertools
+import json
 import math
 import sys
 
 import cv2
 import numpy
-import tensorflow as tf
 
 import common
-import model
+import npmodel
+import weightstore
 
 
-def make_scaled_ims(im, min_shape):
-    ratio = 1. / 2 ** 0.5
-    shape = (im.shape[0] / ratio, im.shape[1] / ratio)
+def plate_width_range(im_shape, scaled_im_shape):
+    """
+    Range of plate widths, in pixels of the original image, which can be
+    detected in an image scaled to `scaled_im_shape`.
+
+    """
+    window_width = (common.WINDOW_SHAPE[1] * float(im_shape[1]) /
+                    scaled_im_shape[1])
+    return (common.PLATE_SCALE_RANGE[0] * window_width,
+            common.PLATE_SCALE_RANGE[1] * window_width)
+
+
+def _check_scale_ratio(ratio):
+    # Any other ratio gives a pyramid which never gets smaller.
+    if not 0 < ratio < 1:
+        raise ValueError("Scale ratio must be between 0 and 1, exclusive, "
+                         "not {!r}".format(ratio))
+
+
+def _check_plate_widths(min_plate_width, max_plate_width):
+    # Reversed bounds would silently give an empty pyramid.
+    if (min_plate_width is not None and max_plate_width is not None and
+            min_plate_width > max_plate_width):
+        raise ValueError("Minimum plate width {} exceeds maximum plate width "
+                         "{}".format(min_plate_width, max_plate_width))
+
+
+def scaled_shapes(im_shape, min_shape, ratio=1. / 2 ** 0.5,
+                  min_plate_width=None, max_plate_width=None):
+    """
+    Shapes of the scales at which an image is searched, from largest to
+    smallest.
+
+    Each scale is `ratio` times the size of the previous one, and the smallest
+    is no smaller than `min_shape`. If `min_plate_width` or `max_plate_width`
+    are given, scales which can only detect plates outside of this range (see
+    `plate_width_range`) are omitted.
+
+    :raises ValueError:
+        If `ratio` is not strictly between 0 and 1, or `min_plate_width`
+        exceeds `max_plate_width`.
+
+    """
+    _check_scale_ratio(ratio)
+    _check_plate_widths(min_plate_width, max_plate_width)
+    shape = (im_shape[0] / ratio, im_shape[1] / ratio)
 
     while True:
         shape = (int(shape[0] * ratio), int(shape[1] * ratio))
         if shape[0] < min_shape[0] or shape[1] < min_shape[1]:
             break
+        min_width, max_width = plate_width_range(im_shape, shape)
+        if min_plate_width is not None and max_width < min_plate_width:
+            continue
+        if max_plate_width is not None and min_width > max_plate_width:
+            break
+        yield shape
+
+
+def make_scaled_ims(im, min_shape, ratio=1. / 2 ** 0.5,
+                    min_plate_width=None, max_plate_width=None):
+    for shape in scaled_shapes(im.shape, min_shape, ratio,
+                               min_plate_width, max_plate_width):
         yield cv2.resize(im, (shape[1], shape[0]))
 
 
+def load_rois(fname, camera=None):
+    """
+    Read regions of interest from a JSON file.
+
+    The file contains either a list of polygons, or an object mapping camera
+    names to lists of polygons. Each polygon is a list of `[x, y]` points, in
+    pixels of the full frame.
+
+    :param fname:
+        File to read.
+
+    :param camera:
+        Name of the camera to read the region of. Required if the file maps
+        camera names to polygons.
+
+    :returns:
+        List of polygons, suitable for the `roi` argument of `Detector`.
+
+    """
+    with open(fname) as f:
+        rois = json.load(f)
+    if isinstance(rois, dict):
+        if camera is None:
+            raise ValueError("{} defines regions for cameras {}, but no "
+                             "camera was given".format(
+                                        fname, ", ".join(sorted(rois))))
+        rois = rois[camera]
+    return [[(float(x), float(y)) for x, y in polygon] for polygon in rois]
+
+
+def roi_mask(im_shape, polygons):
+    """
+    Rasterize a region of interest.
+
+    :param im_shape:
+        Shape of the mask to return.
+
+    :param polygons:
+        List of polygons, as returned by `load_rois`.
+
+    :returns:
+        `uint8` array of shape `im_shape`, which is 1 inside the polygons and
+        0 elsewhere.
+
+    """
+    mask = numpy.zeros(im_shape[:2], dtype=numpy.uint8)
+    cv2.fillPoly(mask,
+                 [numpy.round(numpy.array(polygon)).astype(numpy.int32)
+                      for polygon in polygons],
+                 1)
+    return mask
+
+
+def pyramid_work(im_shape, ratio=1. / 2 ** 0.5, min_plate_width=None,
+                 max_plate_width=None):
+    """
+    Compare the work done searching an image with and without plate width
+    bounds.
+
+    :returns:
+        Dict giving the number of scales, windows and pixels searched with
+        the bounds (`scales`, `windows`, `pixels`), and without
+        (`all_scales`, `all_windows`, `all_pixels`).
+
+    """
+    def work(shapes):
+        return (len(shapes),
+                sum(numpy.prod(_score_map_shape(s)) for s in shapes),
+                sum(s[0] * s[1] for s in shapes))
+
+    bounded = work(list(scaled_shapes(im_shape, common.WINDOW_SHAPE, ratio,
+                                      min_plate_width, max_plate_width)))
+    unbounded = work(list(scaled_shapes(im_shape, common.WINDOW_SHAPE,
+                                        ratio)))
+    return dict(zip(('scales', 'windows', 'pixels',
+                     'all_scales', 'all_windows', 'all_pixels'),
+                    bounded + unbounded))
+
+
+def format_pyramid_work(work):
+    """
+    Describe the result of `pyramid_work` in one line.
+
+    """
+    return ("scales: {} of {}, windows: {} of {}, pixels: {} of {} "
+            "({:.1f}% of work saved)").format(
+                work['scales'], work['all_scales'],
+                work['windows'], work['all_windows'],
+                work['pixels'], work['all_pixels'],
+                100. * (1. - float(work['windows']) /
+                                max(1, work['all_windows'])))
+
+
+def _score_map_shape(im_shape):
+    # Shape of the detect model's output for an input of the given shape. The
+    # pooling layers reduce the input by 8 vertically and 4 horizontally, and
+    # the window itself spans 8x32 of the pooled outputs.
+    return ((im_shape[0] + 7) // 8 - common.WINDOW_SHAPE[0] // 8 + 1,
+            (im_shape[1] + 3) // 4 - common.WINDOW_SHAPE[1] // 4 + 1)
+
+
+def _round_up(n, multiple):
+    return -(-n // multiple) * multiple
+
+
+# Distance in pixels by which the inputs that affect a window's output extend
+# beyond the window itself, rounded up to a multiple of the stride.
+_RECEPTIVE_MARGIN = 32
+
+
+def boxes_touching_mask(bboxes, mask_integral):
+    """
+    Find which boxes contain part of a mask.
+
+    :param bboxes:
+        `N`x4 array of boxes, as in `Matches.bboxes`.
+
+    :param mask_integral:
+        Integral image (as returned by `cv2.integral`) of the mask.
+
+    :returns:
+        Boolean vector which is true for each box containing a non-zero pixel
+        of the mask.
+
+    """
+    limits = numpy.array(mask_integral.shape) - 1
+    tops, lefts = numpy.clip(bboxes[:, :2].astype(numpy.int64), 0, limits).T
+    bottoms, rights = numpy.clip(numpy.ceil(bboxes[:, 2:]).astype(numpy.int64),
+                                 0, limits).T
+
+    return (mask_integral[bottoms, rights] - mask_integral[tops, rights] -
+            mask_integral[bottoms, lefts] + mask_integral[tops, lefts]) > 0
+
+
+def receptive_fields(bboxes):
+    """
+    Expand the boxes of windows to cover the pixels which affect their output.
+
+    :param bboxes:
+        `N`x4 array of window boxes, as in the `Matches.bboxes` returned by
+        `Detector.find_matches` (ie. before grouping).
+
+    :returns:
+        `N`x4 array of boxes, each expanded on every side by
+        `_RECEPTIVE_MARGIN` pixels of the scale the window was evaluated at.
+
+    """
+    margins = (_RECEPTIVE_MARGIN * (bboxes[:, 2:3] - bboxes[:, 0:1]) /
+               float(common.WINDOW_SHAPE[0]))
+    return numpy.hstack([bboxes[:, :2] - margins, bboxes[:, 2:] + margins])
+
+
+def _windows_touching(mask_integral, im_shape, scaled_im_shape,
+                      receptive=False):
+    # Boolean array with the same shape as the detect model's output for the
+    # scaled image, which is true for each window whose box (in original image
+    # coordinates) contains a non-zero pixel of the mask. If `receptive` is
+    # true the window's receptive field is tested rather than its box.
+    img_scale = float(im_shape[0]) / scaled_im_shape[0]
+    h, w = _score_map_shape(scaled_im_shape)
+
+    window_coords = numpy.indices((h, w)).reshape(2, -1).T
+    bbox_tl = window_coords * (8, 4) * img_scale
+    bbox_size = numpy.array(common.WINDOW_SHAPE) * img_scale
+    bboxes = numpy.hstack([bbox_tl, bbox_tl + bbox_size])
+    if receptive:
+        bboxes = receptive_fields(bboxes)
+
+    return boxes_touching_mask(bboxes, mask_integral).reshape(h, w)
+
+
+def _merge_rects(rects):
+    # Repeatedly merge intersecting `top, left, bottom, right` rectangles
+    # until no two intersect.
+    rects = list(rects)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                if (a[0] < b[2] and b[0] < a[2] and
+                    a[1] < b[3] and b[1] < a[3]):
+                    rects[i] = (min(a[0], b[0]), min(a[1], b[1]),
+                                max(a[2], b[2]), max(a[3], b[3]))
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rects
+
+
+def make_mosaic_layout(shapes, gap=(8, 8)):
+    """
+    Work out how to pack images of the given shapes into a single mosaic.
+
+    Images are placed left to right on shelves, in the order given. The
+    mosaic is as wide as the first two images side by side, so for the output
+    of `make_scaled_ims` the largest scale shares the top shelf with the next
+    largest, and the remaining scales are packed onto shelves beneath them.
+
+    Offsets are aligned to the detect model's stride, and images are separated
+    by at least `gap` pixels. A gap of 8 pixels is enough for
+    `model.get_mosaic_detect_model` to give the same results as for the
+    separate images; windows which straddle a gap are simply ignored.
+
+    :param shapes:
+        Shapes of the images to pack.
+
+    :param gap:
+        Minimum vertical and horizontal spacing between images.
+
+    :returns:
+        Pair `mosaic_shape, offsets`, where `offsets` is a list of the
+        `(y, x)` coordinates of the top-left corner of each image.
+
+    """
+    width = max([0] + [shape[1] for shape in shapes])
+    if len(shapes) > 1:
+        width = max(width, _round_up(shapes[0][1] + gap[1], 8) + shapes[1][1])
+
+    offsets = []
+    x, y, shelf_height = 0, 0, 0
+    for shape in shapes:
+        if x > 0 and x + shape[1] > width:
+            x = 0
+            y = _round_up(y + shelf_height + gap[0], 8)
+            shelf_height = 0
+        offsets.append((y, x))
+        shelf_height = max(shelf_height, shape[0])
+        x = _round_up(x + shape[1] + gap[1], 8)
+
+    return (y + shelf_height, width), offsets
+
+
+class Detector(object):
+    """
+    Number plate detector which keeps the detect model loaded between calls.
+
+    The detect graph is built once in a private `tf.Graph`, and the model
+    parameters are loaded into its variables once, when the detector is
+    constructed. Subsequent calls to `detect` only feed image data.
+
+    Alternatively the model can be evaluated with NumPy (see `npmodel`), in
+    which case TensorFlow is not imported at all. This avoids TensorFlow's
+    import and session start up time, which dominates for short-lived
+    processes.
+
+    Call `close` (or use the detector as a context manager) to release the
+    underlying session.
+
+    To find where time is spent, set `profiler` to a `common.Profiler`. The
+    time spent resizing, executing the model and decoding its output is then
+    recorded per scale, along with the number of candidate windows found at
+    each scale, as is the time spent in `post_process`. By default `profiler`
+    is `common.NULL_PROFILER`, which records nothing.
+
+    """
+
+    def __init__(self, param_vals, mosaic=False, scale_ratio=1. / 2 ** 0.5,
+                 presence_param_vals=None, min_presence_prob=0.5,
+                 backend='tensorflow', min_plate_width=None,
+                 max_plate_width=None, roi=None):
+        """
+        :param param_vals:
+            Model parameters to use. These are the parameters output by the
+            `train` module, or by `factorize.py`.
+
+        :param mosaic:
+            If true, pack all scales of an image into a single mosaic (see
+            `make_mosaic_layout`), and execute the model once per image rather
+            than once per scale. The results are the same in either case.
+            This saves per-call overhead, at the cost of also evaluating the
+            windows which straddle the gaps between scales.
+
+        :param scale_ratio:
+            Ratio between the sizes of consecutive scales that images are
+            searched at. Must be strictly between 0 and 1.
+
+        :param presence_param_vals:
+            (Optional.) Parameters of the presence model, as output by
+            `train.train_presence`. If given, the presence model is evaluated
+            at every window, and the full model only at windows where the
+            presence model gives a probability of at least
+            `min_presence_prob`. See `model.get_sparse_detect_model`.
+
+        :param backend:
+            Either `'tensorflow'` or `'numpy'`. The NumPy backend supports
+            neither mosaic mode nor presence models.
+
+        :param min_plate_width:
+            (Optional.) Width in pixels of the narrowest plate to search for.
+            Scales which can only detect narrower plates are skipped.
+
+        :param max_plate_width:
+            (Optional.) Width in pixels of the widest plate to search for.
+            Must be no less than `min_plate_width`.
+
+        :param roi:
+            (Optional.) Region of interest, as a list of polygons, each a list
+            of `(x, y)` points in image coordinates (see `load_rois`). If
+            given, only windows whose boxes touch the region are evaluated,
+            and the model is only executed on crops of each scale around
+            these windows.
+
+        """
+        if mosaic and presence_param_vals is not None:
+            raise ValueError("Mosaic mode cannot be used with a presence "
+                             "model")
+        if backend not in ('tensorflow', 'numpy'):
+            raise ValueError("Unknown backend {!r}".format(backend))
+        if backend == 'numpy' and (mosaic or presence_param_vals is not None):
+            raise ValueError("The numpy backend supports neither mosaic mode "
+                             "nor presence models")
+        self._mosaic = mosaic
+        self._sparse = presence_param_vals is not None
+        self._init_search(scale_ratio, min_plate_width, max_plate_width, roi)
+        self.min_presence_prob = min_presence_prob
+        param_vals = list(param_vals)
+
+        if backend == 'numpy':
+            self._layers = npmodel.detect_layers(param_vals)
+            self._sess = None
+        else:
+            self._init_tensorflow(param_vals, presence_param_vals)
+
+    def _init_search(self, scale_ratio, min_plate_width, max_plate_width, roi):
+        # Parameters controlling which windows are searched, independent of
+        # how the model is evaluated.
+        _check_scale_ratio(scale_ratio)
+        _check_plate_widths(min_plate_width, max_plate_width)
+        self.scale_ratio = scale_ratio
+        self.min_plate_width = min_plate_width
+        self.max_plate_width = max_plate_width
+        self.roi = roi
+        self._roi_integrals = {}
+        self.profiler = common.NULL_PROFILER
+
+    def _init_tensorflow(self, param_vals, presence_param_vals):
+        # TensorFlow is only imported when it is used, so that the NumPy
+        # backend does not pay for it.
+        import tensorflow as tf
+        import model
+
+        fc_ranks = common.fc_ranks(param_vals)
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            if self._mosaic:
+                self._x, self._mask, self._y, params = (
+                                    model.get_mosaic_detect_model(*fc_ranks))
+            elif self._sparse:
+                (self._x, self._conv_layer, self._presence, self._patches,
+                 self._y, params, presence_params) = (
+                                    model.get_sparse_detect_model(*fc_ranks))
+                params = params + presence_params
+                param_vals = param_vals + list(presence_param_vals)
+            else:
+                self._x, self._y, params = model.get_detect_model(*fc_ranks)
+            placeholders = [tf.placeholder(p.dtype.base_dtype, p.get_shape())
+                                for p in params]
+            assign_ops = [p.assign(ph) for p, ph in zip(params, placeholders)]
+        self._graph.finalize()
+
+        self._sess = tf.Session(graph=self._graph, config=tf.ConfigProto())
+        self._sess.run(assign_ops,
+                       feed_dict=dict(zip(placeholders, param_vals)))
+
+    def close(self):
+        if self._sess is not None:
+            self._sess.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def detect(self, im):
+        """
+        Detect number plates in an image.
+
+        :param im:
+            Image to detect number plates in.
+
+        :returns:
+            Iterable of `bbox_tl, bbox_br, present_prob, letter_probs`, as per
+            the module level `detect` function.
+
+        """
+        return iter_matches(self.find_matches([im])[0])
+
+    def detect_batch(self, ims, max_batch_size=None):
+        """
+        Detect number plates in several images at once.
+
+        See `find_matches` for how the images are batched.
+
+        :returns:
+            List containing, for each input image, a list of matches in the
+            form returned by `detect`.
+
+        """
+        return [list(iter_matches(matches))
+                    for matches in self.find_matches(ims, max_batch_size)]
+
+    def find_matches(self, ims, max_batch_size=None):
+        """
+        Detect number plates in several images at once, returning arrays.
+
+        Images are grouped by shape. Each pyramid level of a group is stacked
+        into a single batch, so the model is executed once per level per
+        group, rather than once per level per image.
+
+        :param ims:
+            Sequence of images to detect number plates in.
+
+        :param max_batch_size:
+            (Optional.) Maximum number of images to evaluate in one batch.
+            Larger groups are split into several batches.
+
+        :returns:
+            List containing a `Matches` for each input image.
+
+        """
+        groups = collections.OrderedDict()
+        for idx, im in enumerate(ims):
+            groups.setdefault(im.shape, []).append(idx)
+
+        results = [None] * len(ims)
+        for shape, idxs in groups.items():
+            batch_size = max_batch_size or len(idxs)
+            for start in range(0, len(idxs), batch_size):
+                batch_idxs = idxs[start:start + batch_size]
+
+                # Convert the images to various scales. Images of the same
+                # shape give the same sequence of scaled shapes.
+                scaled_ims = [list(self._scaled_ims(ims[idx]))
+                                  for idx in batch_idxs]
+                batch_matches = [[] for idx in batch_idxs]
+
+                levels = zip(*scaled_ims)
+                if self.roi is not None:
+                    # Only evaluate crops around the windows touching the
+                    # ROI. The crops are the same for every image in the
+                    # batch.
+                    roi_integral = self._roi_integral(shape)
+                    for level, level_ims in enumerate(levels):
+                        window_mask = _windows_touching(roi_integral, shape,
+                                                        level_ims[0].shape)
+                        for matches, level_matches in zip(
+                                batch_matches,
+                                self._find_matches_in_windows(
+                                        shape, numpy.stack(level_ims),
+                                        window_mask, level)):
+                            matches.append(level_matches)
+                else:
+                    if self._mosaic:
+                        with self.profiler.stage("run"):
+                            level_y_vals = self._run_mosaic(levels)
+                    else:
+                        level_y_vals = self._run_levels(levels)
+
+                    for level, (level_ims, y_vals) in enumerate(
+                                                zip(levels, level_y_vals)):
+                        for matches, y_val in zip(batch_matches, y_vals):
+                            matches.append(self._decode_scores(
+                                            shape, level_ims[0].shape, y_val,
+                                            level=level))
+
+                for idx, matches in zip(batch_idxs, batch_matches):
+                    results[idx] = concatenate_matches(matches)
+
+        return results
+
+    def find_matches_masked(self, im, mask, receptive=False):
+        """
+        Detect number plates in part of an image.
+
+        Only the windows whose boxes touch a non-zero pixel of `mask` are
+        evaluated. The model is executed on crops of each scale around these
+        windows, so the cost is roughly proportional to the masked area. The
+        windows evaluated give the same results as with `find_matches`.
+
+        If the detector has an ROI, windows must also touch the ROI.
+
+        :param im:
+            Image to detect number plates in.
+
+        :param mask:
+            Array with the same shape as `im`.
+
+        :param receptive:
+            If true, evaluate the windows whose receptive fields (see
+            `receptive_fields`) touch the mask, rather than their boxes. This
+            selects every window whose output can depend on the masked pixels.
+
+        :returns:
+            A `Matches`.
+
+        """
+        return self._find_matches_masked(im.shape, self._scaled_ims(im), mask,
+                                         receptive)
+
+    def find_matches_coarse_to_fine(self, im, coarse_levels=3, margin=0.5,
+                                    min_coarse_prob=0.5):
+        """
+        Detect number plates in an image, searching coarse scales first.
+
+        The `coarse_levels` smallest scales are searched exhaustively. Finer
+        scales are then only searched near windows at the coarse scales whose
+        presence probability exceeds `min_coarse_prob`. This is much cheaper
+        than an exhaustive search, since the finer scales are the most
+        expensive, but plates which give no coarse response are missed.
+
+        :param im:
+            Image to detect number plates in.
+
+        :param coarse_levels:
+            Number of scales to search exhaustively. Must be positive.
+
+        :param margin:
+            Amount by which to expand the coarse windows before searching the
+            finer scales, as a fraction of the window size.
+
+        :param min_coarse_prob:
+            Presence probability above which a coarse window leads to a search
+            of the finer scales.
+
+        :returns:
+            A `Matches`.
+
+        """
+        if coarse_levels <= 0:
+            raise ValueError("coarse_levels must be positive, not "
+                             "{!r}".format(coarse_levels))
+        scaled_ims = list(self._scaled_ims(im))
+        fine_ims = scaled_ims[:max(0, len(scaled_ims) - coarse_levels)]
+        coarse_ims = scaled_ims[len(fine_ims):]
+
+        def in_roi(m):
+            # The coarse scales are searched in full, so discard windows
+            # outside of the ROI afterwards.
+            if self.roi is None:
+                return m
+            keep = boxes_touching_mask(m.bboxes, self._roi_integral(im.shape))
+            return Matches(*(a[keep] for a in m))
+
+        matches = []
+        mask = numpy.zeros(im.shape, dtype=numpy.uint8)
+        for level, scaled_im in enumerate(coarse_ims, len(fine_ims)):
+            with self.profiler.stage("run", level):
+                y_val = self._run(scaled_im[numpy.newaxis])[0]
+            matches.append(in_roi(self._decode_scores(im.shape,
+                                                      scaled_im.shape, y_val,
+                                                      level=level)))
+
+            candidates = in_roi(_decode_scores(
+                                        im.shape, scaled_im.shape, y_val,
+                                        min_present_prob=min_coarse_prob))
+            for bbox in candidates.bboxes:
+                size = bbox[2:] - bbox[:2]
+                top, left = numpy.maximum(0, bbox[:2] - margin * size)
+                bottom, right = bbox[2:] + margin * size
+                mask[int(top):int(math.ceil(bottom)),
+                     int(left):int(math.ceil(right))] = 1
+
+        if mask.any():
+            matches.append(self._find_matches_masked(im.shape, fine_ims, mask))
+
+        return concatenate_matches(matches)
+
+    def pyramid_work(self, im_shape):
+        """
+        Work saved by this detector's plate width bounds, for an image of the
+        given shape. See the module level `pyramid_work`.
+
+        """
+        return pyramid_work(im_shape, self.scale_ratio, self.min_plate_width,
+                            self.max_plate_width)
+
+    def _scaled_ims(self, im):
+        # As `make_scaled_ims`, but profiled.
+        for level, shape in enumerate(scaled_shapes(im.shape,
+                                                    common.WINDOW_SHAPE,
+                                                    self.scale_ratio,
+                                                    self.min_plate_width,
+                                                    self.max_plate_width)):
+            with self.profiler.stage("resize", level):
+                scaled_im = cv2.resize(im, (shape[1], shape[0]))
+            yield scaled_im
+
+    def _decode_scores(self, im_shape, scaled_im_shape, y_val, offset=(0, 0),
+                       level=None):
+        # As `_decode_scores`, but profiled.
+        with self.profiler.stage("decode", level):
+            matches = _decode_scores(im_shape, scaled_im_shape, y_val, offset)
+        self.profiler.count("decode", len(matches.bboxes), level)
+        return matches
+
+    def _find_matches_masked(self, im_shape, scaled_ims, mask,
+                             receptive=False):
+        mask_integral = cv2.integral((mask != 0).astype(numpy.uint8))
+        roi_integral = (self._roi_integral(im_shape)
+                            if self.roi is not None else None)
+        matches = []
+        for level, scaled_im in enumerate(scaled_ims):
+            window_mask = _windows_touching(mask_integral, im_shape,
+                                            scaled_im.shape, receptive)
+            if roi_integral is not None:
+                window_mask &= _windows_touching(roi_integral, im_shape,
+                                                 scaled_im.shape)
+            matches.append(self._find_matches_in_windows(
+                                        im_shape, scaled_im[numpy.newaxis],
+                                        window_mask, level)[0])
+        return concatenate_matches(matches)
+
+    def _roi_integral(self, im_shape):
+        # Integral image of the ROI mask for images of the given shape.
+        if im_shape not in self._roi_integrals:
+            self._roi_integrals[im_shape] = cv2.integral(
+                                                roi_mask(im_shape, self.roi))
+        return self._roi_integrals[im_shape]
+
+    def _find_matches_in_windows(self, im_shape, scaled_ims, window_mask,
+                                 level=None):
+        # Evaluate the windows selected by `window_mask` of a batch of scaled
+        # images, returning a `Matches` for each image. `level` is the index
+        # of the scale, for profiling.
+        #
+        # Each connected set of selected windows is evaluated on a crop of the
+        # scaled images which covers the windows plus `_RECEPTIVE_MARGIN`, so
+        # that the windows' outputs are unaffected by the crop. Crops are
+        # aligned to the model's stride, so that the windows in a crop line
+        # up with the windows of the full scaled image.
+        if not window_mask.any():
+            return [concatenate_matches([]) for scaled_im in scaled_ims]
+
+        scaled_im_shape = scaled_ims.shape[1:]
+        contours = cv2.findContours(window_mask.astype(numpy.uint8),
+                                    cv2.RETR_EXTERNAL,
+                                    cv2.CHAIN_APPROX_SIMPLE)[0]
+        crops = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            crops.append((max(0, 8 * y - _RECEPTIVE_MARGIN),
+                          max(0, 4 * x - _RECEPTIVE_MARGIN),
+                          min(scaled_im_shape[0],
+                              8 * (y + h - 1) + common.WINDOW_SHAPE[0] +
+                                                        _RECEPTIVE_MARGIN),
+                          min(scaled_im_shape[1],
+                              4 * (x + w - 1) + common.WINDOW_SHAPE[1] +
+                                                        _RECEPTIVE_MARGIN)))
+
+        matches = [[] for scaled_im in scaled_ims]
+        for top, left, bottom, right in _merge_rects(crops):
+            with self.profiler.stage("run", level):
+                y_vals = self._run(scaled_ims[:, top:bottom, left:right])
+            h, w = _score_map_shape((bottom - top, right - left))
+            offset = (top // 8, left // 4)
+            crop_window_mask = window_mask[offset[0]:offset[0] + h,
+                                           offset[1]:offset[1] + w]
+            for im_matches, y_val in zip(matches, y_vals):
+                y_val = y_val[:h, :w].copy()
+                y_val[~crop_window_mask, 0] = -numpy.inf
+                im_matches.append(self._decode_scores(im_shape,
+                                                      scaled_im_shape, y_val,
+                                                      offset, level))
+
+        return [concatenate_matches(m) for m in matches]
+
+    def _run(self, batch):
+        # Execute the model on a batch of images with the same shape.
+        if self._sess is None:
+            return npmodel.forward(batch, self._layers)
+        if self._sparse:
+            return self._run_sparse(batch)
+        feed_dict = {self._x: batch}
+        if self._mosaic:
+            feed_dict[self._mask] = numpy.ones(batch.shape,
+                                               dtype=numpy.float32)
+        return self._sess.run(self._y, feed_dict=feed_dict)
+
+    def _run_sparse(self, batch, max_patches=256):
+        # Execute the presence model at every window, and the full model at
+        # the windows accepted by the presence model. The output has the same
+        # form as the detect model's, except that the presence logit of
+        # rejected windows is -inf.
+        conv_layer, presence = self._sess.run(
+                                    [self._conv_layer, self._presence],
+                                    feed_dict={self._x: batch})
+
+        y_val = numpy.zeros(presence.shape[:3] + (1 + 7 * len(common.CHARS),),
+                            dtype=numpy.float32)
+        y_val[..., 0] = -numpy.inf
+        coords = numpy.argwhere(presence[..., 0] >
+                                -math.log(1. / self.min_presence_prob - 1))
+        if len(coords) == 0:
+            return y_val
+
+        # View the convolutional layers' output as a grid of window patches,
+        # so that the accepted patches can be gathered with one index.
+        n, h, w, c = conv_layer.shape
+        patch_shape = (common.WINDOW_SHAPE[0] // 8,
+                       common.WINDOW_SHAPE[1] // 4)
+        windows = numpy.lib.stride_tricks.as_strided(
+                conv_layer,
+                shape=(n, h - patch_shape[0] + 1, w - patch_shape[1] + 1) +
+                       patch_shape + (c,),
+                strides=conv_layer.strides[:3] + conv_layer.strides[1:])
+
+        for start in range(0, len(coords), max_patches):
+            chunk = coords[start:start + max_patches]
+            patches = windows[chunk[:, 0], chunk[:, 1], chunk[:, 2]]
+            y_val[chunk[:, 0], chunk[:, 1], chunk[:, 2]] = self._sess.run(
+                                            self._y,
+                                            feed_dict={self._patches: patches})
+
+        return y_val
+
+    def _run_levels(self, levels):
+        # Execute the model once for each scale.
+        y_vals = []
+        for level, level_ims in enumerate(levels):
+            with self.profiler.stage("run", level):
+                y_vals.append(self._run(numpy.stack(level_ims)))
+        return y_vals
+
+    def _run_mosaic(self, levels):
+        # Pack all scales into one mosaic per image, execute the model once,
+        # and then cut the output for each scale back out of the mosaic's
+        # output.
+        if not levels:
+            return []
+        shapes = [level_ims[0].shape for level_ims in levels]
+        mosaic_shape, offsets = make_mosaic_layout(shapes)
+
+        mosaics = numpy.zeros((len(levels[0]),) + mosaic_shape,
+                              dtype=numpy.float32)
+        mask = numpy.zeros(mosaic_shape, dtype=numpy.float32)
+        for level_ims, (y, x) in zip(levels, offsets):
+            h, w = level_ims[0].shape
+            mosaics[:, y:y + h, x:x + w] = level_ims
+            mask[y:y + h, x:x + w] = 1.
+
+        y_vals = self._sess.run(
+                    self._y,
+                    feed_dict={self._x: mosaics,
+                               self._mask: numpy.stack([mask] * len(mosaics))})
+
+        out = []
+        for shape, (y, x) in zip(shapes, offsets):
+            h, w = _score_map_shape(shape)
+            out.append(y_vals[:, y // 8:y // 8 + h, x // 4:x // 4 + w])
+        return out
+
+    def post_process(self, matches, strategy='intersect', iou_threshold=0.5):
+        """
+        Merge duplicate matches returned by `detect` or `find_matches`. See
+        `post_process`.
+
+        """
+        with self.profiler.stage("post_process"):
+            grouped = group_matches(matches, strategy, iou_threshold)
+        self.profiler.count("post_process", len(grouped.bboxes))
+        return iter_matches(grouped)
+
+
+class Matches(collections.namedtuple('Matches',
+                                     ['bboxes', 'present_probs',
+                                      'letter_probs'])):
+    """
+    Set of `N` matches, as arrays.
+
+    `bboxes` is an `N`x4 array, where each row is `top, left, bottom, right` in
+    pixel coordinates. `present_probs` is a vector giving the probability that
+    a plate is present in each box, and `letter_probs` is an `N`x7x36 array
+    giving the probability distributions of each letter.
+
+    """
+    __slots__ = ()
+
+
+def concatenate_matches(matches_list):
+    """
+    Concatenate a sequence of `Matches` into a single `Matches`.
+
+    """
+    if not matches_list:
+        return Matches(numpy.zeros((0, 4)),
+                       numpy.zeros((0,)),
+                       numpy.zeros((0, 7, len(common.CHARS))))
+    return Matches(*(numpy.concatenate(arrays)
+                         for arrays in zip(*matches_list)))
+
+
+def iter_matches(matches):
+    """
+    Convert a `Matches` into an iterable of `bbox_tl, bbox_br, present_prob,
+    letter_probs` tuples, as returned by `detect`.
+
+    """
+    for bbox, present_prob, letter_probs in zip(*matches):
+        yield bbox[:2], bbox[2:], present_prob, letter_probs
+
+
+def _decode_scores(im_shape, scaled_im_shape, y_val, offset=(0, 0),
+                   min_present_prob=0.99):
+    # Interpret the results in terms of bounding boxes in the input image.
+    # Do this by identifying windows where the model predicts a number plate
+    # has a greater than `min_present_prob` (by default 99%) probability of
+    # appearing.
+    #
+    # To obtain pixel coordinates, the window coordinates are scaled according
+    # to the stride size, and pixel coordinates. `offset` gives the window
+    # coordinates of `y_val[0, 0]`, when `y_val` covers part of the scaled
+    # image.
+    min_logit = -math.log(1. / min_present_prob - 1)
+    window_coords = numpy.argwhere(y_val[:, :, 0] > min_logit)
+    hits = y_val[window_coords[:, 0], window_coords[:, 1]]
+
+    img_scale = float(im_shape[0]) / scaled_im_shape[0]
+    bbox_tl = (window_coords + offset) * (8, 4) * img_scale
+    bbox_size = numpy.array(common.WINDOW_SHAPE) * img_scale
+
+    letter_probs = common.softmax(
+                        hits[:, 1:].reshape(-1, 7, len(common.CHARS)))
+
+    return Matches(numpy.hstack([bbox_tl, bbox_tl + bbox_size]),
+                   common.sigmoid(hits[:, 0]),
+                   letter_probs)
+
+
 def detect(im, param_vals):
     """
     Detect number plates in an image.
 
+    This builds a fresh `Detector` for each call. When detecting in more than
+    one image, construct a `Detector` once and call its `detect` method
+    instead.
+
     :param im:
         Image to detect number plates in.
 
@@ -72,118 +983,316 @@ def detect(im, param_vals):
         module.
 
     :returns:
-        Iterable of `bbox_tl, bbox_br, letter_probs`, defining the bounding box
-        top-left and bottom-right corners respectively, and a 7,36 matrix
-        giving the probability distributions of each letter.
+        Iterable of `bbox_tl, bbox_br, present_prob, letter_probs`, defining
+        the bounding box top-left and bottom-right corners respectively, the
+        probability that a plate is present, and a 7,36 matrix giving the
+        probability distributions of each letter.
 
     """
+    with Detector(param_vals) as detector:
+        for match in detector.detect(im):
+            yield match
 
-    # Convert the image to various scales.
-    scaled_ims = list(make_scaled_ims(im, model.WINDOW_SHAPE))
 
-    # Load the model which detects number plates over a sliding window.
-    x, y, params = model.get_detect_model()
+def _matches_from_tuples(matches):
+    matches = list(matches)
+    return Matches(
+        numpy.array([numpy.concatenate([numpy.ravel(m[0]), numpy.ravel(m[1])])
+                         for m in matches]).reshape(-1, 4),
+        numpy.array([m[2] for m in matches]).reshape(-1),
+        numpy.array([m[3] for m in matches]).reshape(-1, 7, len(common.CHARS)))
 
-    # Execute the model at each scale.
-    with tf.Session(config=tf.ConfigProto()) as sess:
-        y_vals = []
-        for scaled_im in scaled_ims:
-            feed_dict = {x: numpy.stack([scaled_im])}
-            feed_dict.update(dict(zip(params, param_vals)))
-            y_vals.append(sess.run(y, feed_dict=feed_dict))
 
-    # Interpret the results in terms of bounding boxes in the input image.
-    # Do this by identifying windows (at all scales) where the model predicts a
-    # number plate has a greater than 50% probability of appearing.
-    #
-    # To obtain pixel coordinates, the window coordinates are scaled according
-    # to the stride size, and pixel coordinates.
-    for i, (scaled_im, y_val) in enumerate(zip(scaled_ims, y_vals)):
-        for window_coords in numpy.argwhere(y_val[0, :, :, 0] >
-                                                       -math.log(1./0.99 - 1)):
-            letter_probs = (y_val[0,
-                                  window_coords[0],
-                                  window_coords[1], 1:].reshape(
-                                    7, len(common.CHARS)))
-            letter_probs = common.softmax(letter_probs)
+def _box_areas(bboxes):
+    return ((bboxes[..., 2] - bboxes[..., 0]) *
+            (bboxes[..., 3] - bboxes[..., 1]))
 
-            img_scale = float(im.shape[0]) / scaled_im.shape[0]
 
-            bbox_tl = window_coords * (8, 4) * img_scale
-            bbox_size = numpy.array(model.WINDOW_SHAPE) * img_scale
+def _intersection_areas(a, b):
+    # Area of the intersection of boxes `a` and `b`, broadcasting over all
+    # but the last axis.
+    return (numpy.maximum(0, numpy.minimum(a[..., 2], b[..., 2]) -
+                             numpy.maximum(a[..., 0], b[..., 0])) *
+            numpy.maximum(0, numpy.minimum(a[..., 3], b[..., 3]) -
+                             numpy.maximum(a[..., 1], b[..., 1])))
 
-            present_prob = common.sigmoid(
-                               y_val[0, window_coords[0], window_coords[1], 0])
 
-            yield bbox_tl, bbox_tl + bbox_size, present_prob, letter_probs
+def _overlap_blocks(bboxes, min_iou=None, max_block_elements=1 << 20):
+    """
+    Find overlapping boxes by sweeping down the image.
 
+    Boxes are sorted by their top coordinate, so the boxes that can overlap a
+    given box form a contiguous run after it in the sorted order. Each block
+    of consecutive boxes is tested against the union of their runs at once.
 
-def _overlaps(match1, match2):
-    bbox_tl1, bbox_br1, _, _ = match1
-    bbox_tl2, bbox_br2, _, _ = match2
-    return (bbox_br1[0] > bbox_tl2[0] and
-            bbox_br2[0] > bbox_tl1[0] and
-            bbox_br1[1] > bbox_tl2[1] and
-            bbox_br2[1] > bbox_tl1[1])
+    :param min_iou:
+        If `None`, any pair of boxes which intersect counts as overlapping.
+        Otherwise the intersection over union of the pair must be greater than
+        `min_iou`.
 
+    :returns:
+        Iterable of `rows, cols, overlap`, where `overlap[i, j]` is true if
+        box `rows[i]` overlaps box `cols[j]`. Each overlapping pair appears in
+        exactly one block.
 
-def _group_overlapping_rectangles(matches):
-    matches = list(matches)
-    num_groups = 0
-    match_to_group = {}
-    for idx1 in range(len(matches)):
-        for idx2 in range(idx1):
-            if _overlaps(matches[idx1], matches[idx2]):
-                match_to_group[idx1] = match_to_group[idx2]
+    """
+    order = numpy.argsort(bboxes[:, 0], kind='mergesort')
+    sorted_bboxes = bboxes[order]
+    run_ends = numpy.searchsorted(sorted_bboxes[:, 0], sorted_bboxes[:, 2],
+                                  side='left')
+
+    start = 0
+    while start < len(order):
+        width = max(1, run_ends[start] - start)
+        end = start + max(1, min(len(order) - start,
+                                 width,
+                                 max_block_elements // (2 * width)))
+        col_end = max(run_ends[start:end].max(), end)
+
+        rows = sorted_bboxes[start:end, numpy.newaxis]
+        cols = sorted_bboxes[numpy.newaxis, start:col_end]
+        row_idx = numpy.arange(start, end)[:, numpy.newaxis]
+        col_idx = numpy.arange(start, col_end)[numpy.newaxis, :]
+
+        overlap = ((col_idx > row_idx) &
+                   (col_idx < run_ends[start:end, numpy.newaxis]) &
+                   (cols[..., 1] < rows[..., 3]) &
+                   (rows[..., 1] < cols[..., 3]))
+
+        if min_iou is not None:
+            inter = _intersection_areas(rows, cols)
+            union = _box_areas(rows) + _box_areas(cols) - inter
+            overlap &= inter > min_iou * union
+
+        yield order[start:end], order[start:col_end], overlap
+
+        start = end
+
+
+def _find_roots(parent, idx):
+    roots = parent[idx]
+    while True:
+        next_roots = parent[roots]
+        if numpy.array_equal(next_roots, roots):
+            break
+        roots = next_roots
+    parent[idx] = roots
+    return roots
+
+
+def _connected_components(n, blocks):
+    """
+    Label the connected components of a graph on `n` nodes.
+
+    A union-find structure is updated with a whole block of the adjacency
+    matrix at a time: Each node is linked with the lowest root amongst its
+    neighbours in the block, until every node in the block shares a root with
+    all of its neighbours. Roots are always linked beneath the lowest numbered
+    root, so the label of each component is the index of its first node.
+
+    :param blocks:
+        Iterable of `rows, cols, adjacent` as returned by `_overlap_blocks`.
+
+    :returns:
+        Array giving the label of each node.
+
+    """
+    parent = numpy.arange(n)
+    for rows, cols, adjacent in blocks:
+        has_row = adjacent.any(axis=1)
+        has_col = adjacent.any(axis=0)
+        if not has_row.any():
+            continue
+        rows, cols = rows[has_row], cols[has_col]
+        adjacent = adjacent[has_row][:, has_col]
+
+        while True:
+            row_roots = _find_roots(parent, rows)
+            col_roots = _find_roots(parent, cols)
+            roots = numpy.concatenate([row_roots, col_roots])
+            linked_roots = numpy.concatenate([
+                numpy.where(adjacent, col_roots, n).min(axis=1),
+                numpy.where(adjacent, row_roots[:, numpy.newaxis], n).min(
+                                                                      axis=0)])
+            unmerged = roots != linked_roots
+            if not unmerged.any():
                 break
-        else:
-            match_to_group[idx1] = num_groups 
-            num_groups += 1
+            roots, linked_roots = roots[unmerged], linked_roots[unmerged]
+
+            # Where several nodes link the same root only one assignment will
+            # take effect. The others are retried on the next iteration.
+            parent[numpy.maximum(roots, linked_roots)] = numpy.minimum(
+                                                          roots, linked_roots)
+
+    return _find_roots(parent, numpy.arange(n))
+
+
+def _group_reduce(matches, labels, strategy):
+    # Sort the matches by group, and within each group by descending presence
+    # probability, so that the first match of each group is the best one.
+    _, groups = numpy.unique(labels, return_inverse=True)
+    order = numpy.lexsort((-matches.present_probs, groups))
+    groups = groups[order]
+    starts = numpy.flatnonzero(numpy.r_[True, groups[1:] != groups[:-1]])
+
+    bboxes = matches.bboxes[order]
+    present_probs = matches.present_probs[order]
+    letter_probs = matches.letter_probs[order]
+
+    if strategy == 'intersect':
+        best_bboxes = bboxes[starts]
+        bboxes = numpy.hstack([
+                     numpy.maximum.reduceat(bboxes[:, :2], starts, axis=0),
+                     numpy.minimum.reduceat(bboxes[:, 2:], starts, axis=0)])
+        # A chain of overlapping boxes need not have a common intersection,
+        # in which case the group's best box is used instead.
+        empty = numpy.any(bboxes[:, :2] >= bboxes[:, 2:], axis=1)
+        bboxes[empty] = best_bboxes[empty]
+        letter_probs = letter_probs[starts]
+    elif strategy == 'weighted':
+        weights = present_probs.astype(numpy.float64)
+        total_weights = numpy.add.reduceat(weights, starts)
+        bboxes = (numpy.add.reduceat(bboxes * weights[:, numpy.newaxis],
+                                     starts, axis=0) /
+                  total_weights[:, numpy.newaxis])
+        letter_probs = (numpy.add.reduceat(
+                            letter_probs * weights[:, numpy.newaxis,
+                                                   numpy.newaxis],
+                            starts, axis=0) /
+                        total_weights[:, numpy.newaxis, numpy.newaxis])
+    else:
+        raise ValueError("Unknown grouping strategy {!r}".format(strategy))
+
+    return Matches(bboxes, present_probs[starts], letter_probs)
+
+
+def _non_max_suppression(matches, iou_threshold):
+    # Visit the boxes in order of descending presence probability, keeping
+    # each box which has not been suppressed by a box kept before it, and
+    # suppressing the boxes which overlap each box kept.
+    #
+    # As in `_overlap_blocks` the boxes are sorted by their top coordinate, so
+    # the boxes which can overlap a given box form a contiguous run: those
+    # whose top lies between the box's top less the tallest box's height, and
+    # the box's bottom. Only this run is tested against each kept box.
+    order = numpy.argsort(matches.bboxes[:, 0], kind='mergesort')
+    sorted_bboxes = matches.bboxes[order]
+    tops = sorted_bboxes[:, 0]
+    areas = _box_areas(sorted_bboxes)
+    max_height = numpy.max(sorted_bboxes[:, 2] - sorted_bboxes[:, 0])
+    positions = numpy.empty(len(order), dtype=numpy.int64)
+    positions[order] = numpy.arange(len(order))
 
-    groups = collections.defaultdict(list)
-    for idx, group in match_to_group.items():
-        groups[group].append(matches[idx])
+    suppressed = numpy.zeros(len(order), dtype=numpy.bool_)
+    keep = []
+    for idx in numpy.argsort(-matches.present_probs, kind='mergesort'):
+        pos = positions[idx]
+        if suppressed[pos]:
+            continue
+        keep.append(idx)
 
-    return groups
+        bbox = sorted_bboxes[pos]
+        start = numpy.searchsorted(tops, bbox[0] - max_height, side='left')
+        end = numpy.searchsorted(tops, bbox[2], side='left')
+        run = sorted_bboxes[start:end]
+        inter = _intersection_areas(run, bbox)
+        union = areas[start:end] + areas[pos] - inter
+        suppressed[start:end] |= inter > iou_threshold * union
 
+    return Matches(*(a[keep] for a in matches))
 
-def post_process(matches):
+
+def group_matches(matches, strategy='intersect', iou_threshold=0.5):
+    """
+    Merge duplicate matches.
+
+    :param matches:
+        A `Matches`, or an iterable of matches as returned by `detect`.
+
+    :param strategy:
+        How to merge matches. One of:
+          - `'intersect'`: Merge each set of transitively overlapping boxes
+            into the intersection of the set. The presence probability and
+            letter probabilities are those of the box with the highest
+            presence probability.
+          - `'nms'`: Greedy non-maximum suppression. Keep the box with the
+            highest presence probability, discard the boxes whose
+            intersection over union with it exceeds `iou_threshold`, and
+            repeat on the remaining boxes.
+          - `'weighted'`: Merge each set of boxes transitively linked by an
+            intersection over union greater than `iou_threshold`. The box and
+            letter probabilities are averaged, weighted by presence
+            probability.
+
+    :param iou_threshold:
+        Intersection over union threshold used by the `'nms'` and
+        `'weighted'` strategies.
+
+    :returns:
+        A `Matches` containing the merged matches. For the `'intersect'` and
+        `'weighted'` strategies these are ordered by the first match in each
+        group, for `'nms'` by descending presence probability.
+
+    """
+    if not isinstance(matches, Matches):
+        matches = _matches_from_tuples(matches)
+    if len(matches.bboxes) == 0:
+        return matches
+
+    if strategy == 'nms':
+        return _non_max_suppression(matches, iou_threshold)
+
+    min_iou = None if strategy == 'intersect' else iou_threshold
+    labels = _connected_components(
+                        len(matches.bboxes),
+                        _overlap_blocks(matches.bboxes, min_iou=min_iou))
+    return _group_reduce(matches, labels, strategy)
+
+
+def post_process(matches, strategy='intersect', iou_threshold=0.5):
     """
-    Take an iterable of matches as returned by `detect` and merge duplicates.
+    Take an iterable of matches as returned by `detect` (or a `Matches`) and
+    merge duplicates.
 
-    Merging consists of two steps:
+    With the default strategy merging consists of two steps:
       - Finding sets of overlapping rectangles.
       - Finding the intersection of those sets, along with the code
         corresponding with the rectangle with the highest presence parameter.
 
-    """
-    groups = _group_overlapping_rectangles(matches)
+    See `group_matches` for the other strategies.
 
-    for group_matches in groups.values():
-        mins = numpy.stack(numpy.array(m[0]) for m in group_matches)
-        maxs = numpy.stack(numpy.array(m[1]) for m in group_matches)
-        present_probs = numpy.array([m[2] for m in group_matches])
-        letter_probs = numpy.stack(m[3] for m in group_matches)
-
-        yield (numpy.max(mins, axis=0).flatten(),
-               numpy.min(maxs, axis=0).flatten(),
-               numpy.max(present_probs),
-               letter_probs[numpy.argmax(present_probs)])
+    """
+    return iter_matches(group_matches(matches, strategy, iou_threshold))
 
 
 def letter_probs_to_code(letter_probs):
     return "".join(common.CHARS[i] for i in numpy.argmax(letter_probs, axis=1))
 
 
-if __name__ == "__main__":
-    im = cv2.imread(sys.argv[1])
-    im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) / 255.
+def match_to_dict(bbox_tl, bbox_br, present_prob, letter_probs):
+    """
+    Convert a match, as returned by `post_process`, into a JSON serializable
+    dict with keys `bbox` (`[top, left, bottom, right]`), `present_prob` and
+    `code`.
+
+    """
+    return dict(bbox=[float(v) for v in tuple(bbox_tl) + tuple(bbox_br)],
+                present_prob=float(present_prob),
+                code=letter_probs_to_code(letter_probs))
 
-    f = numpy.load(sys.argv[2])
-    param_vals = [f[n] for n in sorted(f.files, key=lambda s: int(s[4:]))]
 
-    for pt1, pt2, present_prob, letter_probs in post_process(
-                                                  detect(im_gray, param_vals)):
+def annotate(im, matches):
+    """
+    Draw the bounding box and code of each match onto an image, in place.
+
+    :param im:
+        BGR image to draw on.
+
+    :param matches:
+        Iterable of matches, as returned by `post_process`.
+
+    """
+    for pt1, pt2, present_prob, letter_probs in matches:
         pt1 = tuple(reversed(map(int, pt1)))
         pt2 = tuple(reversed(map(int, pt2)))
 
@@ -208,5 +1317,183 @@ if __name__ == "__main__":
                     (255, 255, 255),
                     thickness=2)
 
-    cv2.imwrite(sys.argv[3], im)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect number plates.")
+    parser.add_argument("input",
+                        help="Image to detect number plates in. With "
+                             "--video, a video file or capture device number. "
+                             "With --batch, a glob, a directory, or @ "
+                             "followed by a file listing one image per line.")
+    parser.add_argument("weights", help="Weights file output by train.py.")
+    parser.add_argument("output",
+                        nargs="?",
+                        help="Where to write the annotated image or video. "
+                             "With --batch, the JSON lines file to append "
+                             "results to.")
+    parser.add_argument("--video",
+                        action="store_true",
+                        help="Process a video stream rather than an image.")
+    parser.add_argument("--real-time",
+                        action="store_true",
+                        help="With --video, drop frames rather than wait when "
+                             "detection falls behind the stream.")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="With --video, only evaluate the parts of each "
+                             "frame which have changed. Suitable for fixed "
+                             "cameras.")
+    parser.add_argument("--batch",
+                        action="store_true",
+                        help="Process many images, writing the plates found "
+                             "in each as JSON lines. Images already in the "
+                             "output are skipped, so that an interrupted run "
+                             "can be resumed.")
+    parser.add_argument("--annotate-dir",
+                        help="With --batch, write annotated images to this "
+                             "directory.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=4,
+                        help="With --batch, number of workers decoding "
+                             "images.")
+    parser.add_argument("--processes",
+                        action="store_true",
+                        help="With --batch, decode images in worker processes "
+                             "rather than threads.")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=8,
+                        help="With --batch, number of images to detect at "
+                             "once.")
+    parser.add_argument("--scale-ratio",
+                        type=float,
+                        default=1. / 2 ** 0.5,
+                        help="Ratio between consecutive scales searched, "
+                             "between 0 and 1.")
+    parser.add_argument("--min-plate-width",
+                        type=float,
+                        help="Width in pixels of the narrowest plate to "
+                             "search for.")
+    parser.add_argument("--max-plate-width",
+                        type=float,
+                        help="Width in pixels of the widest plate to search "
+                             "for.")
+    parser.add_argument("--roi",
+                        help="JSON file giving regions of interest, as a list "
+                             "of polygons of [x, y] points, or an object "
+                             "mapping camera names to such lists. Only "
+                             "windows touching the region are searched.")
+    parser.add_argument("--camera",
+                        help="With --roi, the camera whose region to use.")
+    parser.add_argument("--coarse-levels",
+                        type=int,
+                        help="Search this many of the coarsest scales "
+                             "exhaustively, and the finer scales only near "
+                             "coarse detections. Not supported with --batch "
+                             "or --video.")
+    parser.add_argument("--presence-weights",
+                        help="Presence head weights output by "
+                             "`train.py --presence`. Only windows accepted by "
+                             "the presence head are fully evaluated.")
+    parser.add_argument("--min-presence-prob",
+                        type=float,
+                        default=0.5,
+                        help="With --presence-weights, the presence head "
+                             "probability required to evaluate a window.")
+    parser.add_argument("--quantized",
+                        action="store_true",
+                        help="The weights are int8 quantized weights output "
+                             "by `quantize.py calibrate`.")
+    parser.add_argument("--backend",
+                        choices=("tensorflow", "numpy"),
+                        default="tensorflow",
+                        help="How to evaluate the model. The numpy backend "
+                             "does not import TensorFlow, so starts faster.")
+    parser.add_argument("--profile",
+                        nargs="?",
+                        const="table",
+                        choices=("table", "json"),
+                        help="Report the time spent in each stage of "
+                             "detection, per scale, on stderr, as a table "
+                             "(the default) or as JSON.")
+    args = parser.parse_args()
+    if not 0 < args.scale_ratio < 1:
+        parser.error("--scale-ratio must be between 0 and 1, exclusive")
+    if (args.min_plate_width is not None and
+            args.max_plate_width is not None and
+            args.min_plate_width > args.max_plate_width):
+        parser.error("--min-plate-width exceeds --max-plate-width")
+    if args.coarse_levels is not None and args.coarse_levels <= 0:
+        parser.error("--coarse-levels must be positive")
+    if args.coarse_levels is not None and (args.batch or args.video):
+        parser.error("--coarse-levels cannot be used with --batch or --video")
+
+    roi = None
+    if args.roi is not None:
+        roi = load_rois(args.roi, args.camera)
+
+    if args.quantized:
+        import quantize
+        detector = quantize.QuantizedDetector(
+                                quantize.load_quantized(args.weights),
+                                scale_ratio=args.scale_ratio,
+                                min_plate_width=args.min_plate_width,
+                                max_plate_width=args.max_plate_width,
+                                roi=roi)
+    else:
+        presence_param_vals = None
+        if args.presence_weights is not None:
+            presence_param_vals = weightstore.load_weights(
+                                                    args.presence_weights)
+        detector = Detector(weightstore.load_weights(args.weights),
+                            scale_ratio=args.scale_ratio,
+                            presence_param_vals=presence_param_vals,
+                            min_presence_prob=args.min_presence_prob,
+                            backend=args.backend,
+                            min_plate_width=args.min_plate_width,
+                            max_plate_width=args.max_plate_width,
+                            roi=roi)
+
+    if args.profile is not None:
+        detector.profiler = common.Profiler()
+
+    with detector:
+        if args.batch:
+            if args.output is None:
+                parser.error("an output file is required")
+            import batch
+            batch.main(args.input, detector, args.output,
+                       batch_size=args.batch_size,
+                       workers=args.workers,
+                       processes=args.processes,
+                       annotate_dir=args.annotate_dir)
+        elif args.video:
+            import stream
+            stream.main(args.input, detector, args.output,
+                        real_time=args.real_time,
+                        incremental=args.incremental)
+        else:
+            if args.output is None:
+                parser.error("an output image is required")
+
+            with detector.profiler.stage("read"):
+                im = cv2.imread(args.input)
+                im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) / 255.
+            print >>sys.stderr, format_pyramid_work(
+                                    detector.pyramid_work(im_gray.shape))
+
+            if args.coarse_levels is None:
+                matches = detector.find_matches([im_gray])[0]
+            else:
+                matches = detector.find_matches_coarse_to_fine(
+                                im_gray, coarse_levels=args.coarse_levels)
+            plates = list(detector.post_process(matches))
+            with detector.profiler.stage("annotate"):
+                annotate(im, plates)
+                cv2.imwrite(args.output, im)
+
+    if args.profile == "table":
+        print >>sys.stderr, detector.profiler.format_table()
+    elif args.profile == "json":
+        print >>sys.stderr, detector.profiler.to_json()
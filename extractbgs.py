@@ -21,10 +21,18 @@
 #     USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
-
 """
 Extract background images from a tar archive.
 
+The archive is read as a stream, and its JPEGs are decoded, cropped and
+resized by a pool of worker processes, while the results are written out in
+archive order. Backgrounds are written either as `bgs/########.jpg`, or
+directly into a background bank (see `bgbank`).
+
+Backgrounds identical to one already written are skipped. Progress is
+recorded in a state file next to the output directory, so an interrupted
+extraction can be resumed by repeating the same command.
+
 """
 
 
@@ -33,66 +41,257 @@ __all__ = (
 )
 
 
+import argparse
+import collections
+import hashlib
+import json
+import multiprocessing
 import os
-import sys
+import signal
 import tarfile
 
 import cv2
 import numpy
 
+import bgbank
+import gen
+
+
+def _init_worker():
+    # Keyboard interrupts are left to the main process, which terminates the
+    # workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _process(data, encode):
+    # Runs in a worker. Decode a JPEG, crop it square and shrink it to at most
+    # 256x256. Returns the SHA-1 of the resulting pixels and either the image,
+    # or if `encode` is true the image encoded as a JPEG. Returns `None` if
+    # the JPEG cannot be decoded.
+    im = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8),
+                      cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    if im is None:
+        return None
+
+    if im.shape[0] > im.shape[1]:
+        im = im[:im.shape[1], :]
+    else:
+        im = im[:, :im.shape[0]]
+    if im.shape[0] > 256:
+        im = cv2.resize(im, (256, 256))
+    im = numpy.ascontiguousarray(im)
+
+    digest = hashlib.sha1(im.data).hexdigest()
+    if encode:
+        ok, buf = cv2.imencode(".jpg", im)
+        if not ok:
+            raise Exception("Failed to encode image")
+        return digest, buf.tostring()
+    return digest, im
+
+
+def _iter_jpegs(archive_name, skip):
+    # Yield the contents of each JPEG in the archive, after the first `skip`.
+    # The archive is read as a stream, so compressed archives are not seeked.
+    t = tarfile.open(name=archive_name, mode="r|*")
+    try:
+        count = 0
+        for m in t:
+            if not m.name.endswith(".jpg"):
+                continue
+            count += 1
+            if count <= skip:
+                continue
+            f = t.extractfile(m)
+            try:
+                yield f.read()
+            finally:
+                f.close()
+    finally:
+        t.close()
+
+
+def _iter_processed(pool, jpegs, encode, max_pending):
+    # Process JPEGs in `pool`, yielding the results in order, with at most
+    # `max_pending` read but not yet yielded.
+    pending = collections.deque()
+    for data in jpegs:
+        pending.append(pool.apply_async(_process, (data, encode)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class _JpegWriter(object):
+    # Writes backgrounds as numbered JPEGs, as read by `gen.generate_bg`.
+    def __init__(self, out_dir, count):
+        self.out_dir = out_dir
+        self.count = count
+
+    def add(self, data):
+        fname = os.path.join(self.out_dir, "{:08}.jpg".format(self.count))
+        with open(fname, "wb") as f:
+            f.write(data)
+        self.count += 1
+
+    def flush(self):
+        pass
 
-def im_from_file(f):
-    a = numpy.asarray(bytearray(f.read()), dtype=numpy.uint8)
-    return cv2.imdecode(a, cv2.CV_LOAD_IMAGE_GRAYSCALE)
+    def close(self):
+        pass
 
 
-def extract_backgrounds(archive_name):
+def _state_fnames(out_dir):
+    # The state is kept outside of `out_dir`, which `gen.generate_bg` expects
+    # to contain only backgrounds.
+    base = os.path.normpath(out_dir)
+    return base + ".state.json", base + ".hashes"
+
+
+def _write_json(fname, obj):
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(obj, f)
+    os.rename(tmp_fname, fname)
+
+
+def extract_backgrounds(archive_name, out_dir="bgs", fmt="jpg",
+                        processes=None, dedup=True, checkpoint_interval=1000,
+                        max_shard_bytes=1 << 30):
     """
     Extract backgrounds from provided tar archive.
 
     JPEGs from the archive are converted into grayscale, and cropped/resized to
-    256x256, and saved in ./bgs/.
+    256x256, and saved in `out_dir`.
 
     :param archive_name:
         Name of the .tar file containing JPEGs of background images.
 
+    :param out_dir:
+        Directory to write the backgrounds to. It must not already exist,
+        unless resuming.
+
+    :param fmt:
+        `'jpg'` to write backgrounds as `out_dir/########.jpg`, or `'bank'`
+        to write a background bank. Backgrounds smaller than a detection
+        window are left out of a bank.
+
+    :param processes:
+        Number of worker processes. Defaults to the number of CPUs.
+
+    :param dedup:
+        If true, skip backgrounds whose pixels are identical to a background
+        already written.
+
+    :param checkpoint_interval:
+        Number of archive members between checkpoints. An interrupted
+        extraction resumes from the last checkpoint.
+
+    :param max_shard_bytes:
+        With `fmt='bank'`, see `bgbank.BankWriter`.
+
     """
-    os.mkdir("bgs")
-
-    t = tarfile.open(name=archive_name)
-
-    def members():
-        m = t.next()
-        while m:
-            yield m
-            m = t.next()
-    index = 0
-    for m in members():
-        if not m.name.endswith(".jpg"):
-            continue
-        f =  t.extractfile(m)
-        try:
-            im = im_from_file(f)
-        finally:
-            f.close()
-        if im is None:
-            continue
-        
-        if im.shape[0] > im.shape[1]:
-            im = im[:im.shape[1], :]
-        else:
-            im = im[:, :im.shape[0]]
-        if im.shape[0] > 256:
-            im = cv2.resize(im, (256, 256))
-        fname = "bgs/{:08}.jpg".format(index)
-        print fname
-        rc = cv2.imwrite(fname, im)
-        if not rc:
-            raise Exception("Failed to write file {}".format(fname))
-        index += 1
+    if fmt not in ('jpg', 'bank'):
+        raise ValueError("Unknown format {!r}".format(fmt))
 
+    state_fname, hashes_fname = _state_fnames(out_dir)
+    if os.path.exists(state_fname):
+        with open(state_fname) as f:
+            state = json.load(f)
+        if state['format'] != fmt:
+            raise ValueError("{} was started with format {!r}".format(
+                                                    out_dir, state['format']))
+        if state['complete']:
+            return
+        print "Resuming after {} members".format(state['members'])
+    else:
+        os.mkdir(out_dir)
+        state = dict(format=fmt, members=0, images=0, complete=False)
+        # Write the state straight away, so that a run interrupted before the
+        # first checkpoint can still be resumed.
+        _write_json(state_fname, state)
 
-if __name__ == "__main__":
+    # Keep the hashes of the images written before the last checkpoint.
+    hashes = []
+    if state['images']:
+        with open(hashes_fname) as f:
+            hashes = [line.strip() for _, line in zip(range(state['images']),
+                                                      f)]
+    with open(hashes_fname, "w") as f:
+        f.writelines(h + "\n" for h in hashes)
+    seen = set(hashes)
+
+    if fmt == 'bank':
+        writer = bgbank.BankWriter(out_dir, max_shard_bytes,
+                                   keep=state['images'])
+    else:
+        writer = _JpegWriter(out_dir, state['images'])
+
+    def checkpoint():
+        writer.flush()
+        hashes_file.flush()
+        os.fsync(hashes_file.fileno())
+        _write_json(state_fname, state)
+        print "{} members read, {} backgrounds written".format(
+                                            state['members'], state['images'])
 
-    extract_backgrounds(sys.argv[1])
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, _init_worker)
+    hashes_file = open(hashes_fname, "a")
+    try:
+        for result in _iter_processed(pool,
+                                      _iter_jpegs(archive_name,
+                                                  state['members']),
+                                      encode=fmt == 'jpg',
+                                      max_pending=4 * processes):
+            state['members'] += 1
+            if result is not None:
+                digest, im = result
+                if ((not dedup or digest not in seen) and
+                    (fmt == 'jpg' or
+                     (im.shape[0] >= gen.OUTPUT_SHAPE[0] and
+                      im.shape[1] >= gen.OUTPUT_SHAPE[1]))):
+                    seen.add(digest)
+                    writer.add(im)
+                    hashes_file.write(digest + "\n")
+                    state['images'] += 1
+            if state['members'] % checkpoint_interval == 0:
+                checkpoint()
+
+        writer.close()
+        state['complete'] = True
+        checkpoint()
+    finally:
+        pool.terminate()
+        pool.join()
+        hashes_file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                description="Extract background images from a tar archive.")
+    parser.add_argument("archive", help="Tar archive of JPEGs.")
+    parser.add_argument("--format",
+                        choices=("jpg", "bank"),
+                        default="jpg",
+                        help="Write numbered JPEGs (the default), or a "
+                             "background bank for bgbank.py.")
+    parser.add_argument("--output",
+                        help="Output directory. Defaults to bgs for JPEGs, "
+                             "and bgbank for a bank.")
+    parser.add_argument("--processes", type=int,
+                        help="Number of worker processes. Defaults to the "
+                             "number of CPUs.")
+    parser.add_argument("--no-dedup",
+                        action="store_true",
+                        help="Keep backgrounds identical to one already "
+                             "written.")
+    args = parser.parse_args()
 
+    if args.output is None:
+        args.output = "bgs" if args.format == "jpg" else "bgbank"
+    extract_backgrounds(args.archive, args.output, args.format,
+                        processes=args.processes,
+                        dedup=not args.no_dedup)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Low-rank factorization of the fully connected layers.
+
+The weights of the first fully connected layer account for almost all of the
+model's parameters, and most of the cost of evaluating each window. This
+script replaces them (and optionally the weights of the second fully connected
+layer) with the product of a pair of rank `r` matrices, obtained by truncated
+SVD. The factorized weights can be used anywhere the original weights can,
+and can be fine-tuned by passing them to `train.py`.
+
+`compress` writes factorized weights, and `evaluate` reports the size,
+accuracy and speed of the model for a range of ranks, so that a rank can be
+chosen.
+
+"""
+
+
+__all__ = (
+    'evaluate',
+    'factorize',
+    'time_detect',
+)
+
+
+import argparse
+import time
+
+import cv2
+import numpy
+import tensorflow as tf
+
+import common
+import detect
+import model
+import train
+import weightstore
+
+
+def _svd(W):
+    # Split the singular values evenly between the two factors, so that the
+    # factors have similar scales.
+    u, s, vt = numpy.linalg.svd(W, full_matrices=False)
+    s_sqrt = numpy.sqrt(s)
+    return u * s_sqrt, s_sqrt[:, numpy.newaxis] * vt
+
+
+def _fc_svds(param_vals, fc2=True):
+    if common.fc_ranks(param_vals) != (None, None):
+        raise ValueError("Weights are already factorized")
+    return [_svd(param_vals[6]), _svd(param_vals[8]) if fc2 else None]
+
+
+def _factorize(param_vals, fc_svds, fc1_rank, fc2_rank):
+    out = list(param_vals[:6])
+    for W, b, svd, rank in zip((param_vals[6], param_vals[8]),
+                               (param_vals[7], param_vals[9]),
+                               fc_svds,
+                               (fc1_rank, fc2_rank)):
+        if rank is None:
+            out.append(W)
+        else:
+            left, right = svd
+            out += [numpy.ascontiguousarray(left[:, :rank]),
+                    numpy.ascontiguousarray(right[:rank])]
+        out.append(b)
+    return out
+
+
+def factorize(param_vals, fc1_rank, fc2_rank=None):
+    """
+    Factorize the fully connected layers of a set of model parameters.
+
+    :param param_vals:
+        Unfactorized model parameters, as output by `train.train`.
+
+    :param fc1_rank:
+        Rank to factorize the first fully connected layer's weights to.
+
+    :param fc2_rank:
+        (Optional.) Rank to factorize the second fully connected layer's
+        weights to. If not given the layer is left unfactorized.
+
+    :return:
+        Parameters for the model returned by `model.get_training_model` (or
+        similar) with the given ranks.
+
+    """
+    fc_svds = _fc_svds(param_vals, fc2=fc2_rank is not None)
+    return _factorize(param_vals, fc_svds, fc1_rank, fc2_rank)
+
+
+def evaluate(param_vals, test_xs, test_ys):
+    """
+    Evaluate a set of model parameters against labelled windows.
+
+    :param param_vals:
+        Model parameters, factorized or otherwise.
+
+    :param test_xs:
+        Array of 64x128 windows.
+
+    :param test_ys:
+        Corresponding labels, as output by `train.read_data`.
+
+    :return:
+        The fraction of windows whose presence and characters were correctly
+        predicted, and the fraction whose presence was correctly predicted. As
+        in `train.train`, the characters of windows correctly predicted to not
+        contain a plate are not considered.
+
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        x, y, params = model.get_training_model(
+                                            *common.fc_ranks(param_vals))
+        placeholders = [tf.placeholder(p.dtype.base_dtype, p.get_shape())
+                            for p in params]
+        assign_ops = [p.assign(ph) for p, ph in zip(params, placeholders)]
+    graph.finalize()
+
+    with tf.Session(graph=graph) as sess:
+        sess.run(assign_ops, feed_dict=dict(zip(placeholders, param_vals)))
+        y_val = sess.run(y, feed_dict={x: test_xs})
+
+    def best(v):
+        return numpy.argmax(v[:, 1:].reshape(-1, 7, len(common.CHARS)), 2)
+
+    present = y_val[:, 0] > 0
+    expected_present = test_ys[:, 0] > 0.5
+    presence_correct = present == expected_present
+    correct = presence_correct & (~present |
+                                  numpy.all(best(y_val) == best(test_ys), 1))
+
+    return numpy.mean(correct), numpy.mean(presence_correct)
+
+
+def time_detect(param_vals, im, reps=3):
+    """
+    Time a `detect.Detector` search of a single image.
+
+    :param param_vals:
+        Model parameters, factorized or otherwise.
+
+    :param im:
+        Grayscale image to search.
+
+    :param reps:
+        Number of times to repeat the search. An initial untimed search is
+        made to warm up the session.
+
+    :return:
+        Mean time taken per search, in seconds.
+
+    """
+    with detect.Detector(param_vals) as detector:
+        detector.find_matches([im])
+        start = time.time()
+        for _ in range(reps):
+            detector.find_matches([im])
+        return (time.time() - start) / reps
+
+
+def _size(param_vals):
+    return sum(p.nbytes for p in param_vals)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                        description="Low-rank factorization of the fully "
+                                    "connected layers.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    compress_parser = subparsers.add_parser(
+                        "compress",
+                        help="Write factorized weights.")
+    compress_parser.add_argument("weights", help="Weights file.")
+    compress_parser.add_argument("output",
+                                 help="Where to write the factorized "
+                                      "weights.")
+    compress_parser.add_argument("--fc1-rank", type=int, required=True)
+    compress_parser.add_argument("--fc2-rank", type=int)
+
+    evaluate_parser = subparsers.add_parser(
+                        "evaluate",
+                        help="Report size, accuracy and speed for a range of "
+                             "ranks.")
+    evaluate_parser.add_argument("weights", help="Weights file.")
+    evaluate_parser.add_argument("--fc1-ranks",
+                                 default="32,64,128,256,512",
+                                 help="Comma separated ranks to evaluate.")
+    evaluate_parser.add_argument("--fc2-rank", type=int)
+    evaluate_parser.add_argument("--test-glob", default="test/*.png",
+                                 help="Labelled windows, as output by "
+                                      "gen.py.")
+    evaluate_parser.add_argument("--image",
+                                 help="Image to time detection with. By "
+                                      "default a random 240x320 image is "
+                                      "used.")
+
+    args = parser.parse_args()
+
+    param_vals = weightstore.load_weights(args.weights)
+
+    if args.command == "compress":
+        numpy.savez(args.output,
+                    *factorize(param_vals, args.fc1_rank, args.fc2_rank))
+    elif args.command == "evaluate":
+        test_xs, test_ys = train.unzip(list(train.read_data(args.test_glob)))
+        if args.image is not None:
+            im = cv2.cvtColor(cv2.imread(args.image),
+                              cv2.COLOR_BGR2GRAY) / 255.
+        else:
+            im = numpy.random.RandomState(0).rand(240, 320)
+
+        fc_svds = _fc_svds(param_vals, fc2=args.fc2_rank is not None)
+        ranks = [None] + [int(r) for r in args.fc1_ranks.split(",")]
+
+        print "{:>6} {:>10} {:>9} {:>9} {:>9}".format(
+                    "rank", "size (MB)", "accuracy", "presence", "time (s)")
+        for rank in ranks:
+            if rank is None:
+                vals = param_vals
+            else:
+                vals = _factorize(param_vals, fc_svds, rank, args.fc2_rank)
+            accuracy, presence_accuracy = evaluate(vals, test_xs, test_ys)
+            print "{:>6} {:10.1f} {:8.2f}% {:8.2f}% {:9.3f}".format(
+                        "full" if rank is None else rank,
+                        _size(vals) / 1e6,
+                        100. * accuracy,
+                        100. * presence_accuracy,
+                        time_detect(vals, im))
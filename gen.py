@@ -25,19 +25,29 @@
 """
 Generate training and test images.
 
+With `--bench`, rather than writing images, time their generation and report
+the time spent in each stage of `generate_im`.
+
 """
 
 
 __all__ = (
+    'GlyphAtlas',
+    'benchmark',
     'generate_ims',
+    'load_fonts',
 )
 
 
+import argparse
+import hashlib
 import itertools
 import math
+import multiprocessing
 import os
 import random
 import sys
+import time
 
 import cv2
 import numpy
@@ -46,9 +56,12 @@ from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 
+import bgbank
 import common
 
 FONT_DIR = "./fonts"
+BANK_DIR = "bgbank"
+GLYPH_CACHE_DIR = ".glyphcache"  # Relative to the font directory
 FONT_HEIGHT = 32  # Pixel size to which the chars are resized
 
 OUTPUT_SHAPE = (64, 128)
@@ -214,11 +227,14 @@ def generate_plate(font_height, char_ims):
     return plate, rounded_rect(out_shape, radius), code.replace(" ", "")
 
 
-def generate_bg(num_bg_images):
+def generate_bg(num_bg_images, bg_dir="bgs",
+                profiler=common.NULL_PROFILER):
     found = False
     while not found:
-        fname = "bgs/{:08d}.jpg".format(random.randint(0, num_bg_images - 1))
+        fname = os.path.join(bg_dir, "{:08d}.jpg".format(
+                                    random.randint(0, num_bg_images - 1)))
         bg = cv2.imread(fname, cv2.CV_LOAD_IMAGE_GRAYSCALE) / 255.
+        profiler.count("bg", 1)
         if (bg.shape[1] >= OUTPUT_SHAPE[1] and
             bg.shape[0] >= OUTPUT_SHAPE[0]):
             found = True
@@ -230,63 +246,292 @@ def generate_bg(num_bg_images):
     return bg
 
 
-def generate_im(char_ims, num_bg_images):
-    bg = generate_bg(num_bg_images)
-
-    plate, plate_mask, code = generate_plate(FONT_HEIGHT, char_ims)
+def generate_im(char_ims, num_bg_images, bg_dir="bgs",
+                profiler=common.NULL_PROFILER, bank=None):
+    # `profiler` records the time spent in each stage. The number of
+    # background images read, including those rejected for being too small,
+    # is recorded as the "bg" stage's item count. If a `bgbank.BackgroundBank`
+    # is given backgrounds are cropped from it, rather than read from
+    # `bg_dir`.
+    with profiler.stage("bg"):
+        if bank is not None:
+            bg = bank.random_crop(OUTPUT_SHAPE) / 255.
+            profiler.count("bg", 1)
+        else:
+            bg = generate_bg(num_bg_images, bg_dir, profiler)
+
+    with profiler.stage("plate"):
+        plate, plate_mask, code = generate_plate(FONT_HEIGHT, char_ims)
     
-    M, out_of_bounds = make_affine_transform(
-                            from_shape=plate.shape,
-                            to_shape=bg.shape,
-                            min_scale=0.6,
-                            max_scale=0.875,
-                            rotation_variation=1.0,
-                            scale_variation=1.5,
-                            translation_variation=1.2)
-    plate = cv2.warpAffine(plate, M, (bg.shape[1], bg.shape[0]))
-    plate_mask = cv2.warpAffine(plate_mask, M, (bg.shape[1], bg.shape[0]))
+    with profiler.stage("affine"):
+        M, out_of_bounds = make_affine_transform(
+                                from_shape=plate.shape,
+                                to_shape=bg.shape,
+                                min_scale=common.PLATE_SCALE_RANGE[0],
+                                max_scale=common.PLATE_SCALE_RANGE[1],
+                                rotation_variation=1.0,
+                                scale_variation=1.5,
+                                translation_variation=1.2)
+    with profiler.stage("warp"):
+        plate = cv2.warpAffine(plate, M, (bg.shape[1], bg.shape[0]))
+        plate_mask = cv2.warpAffine(plate_mask, M,
+                                    (bg.shape[1], bg.shape[0]))
+
+    with profiler.stage("blend"):
+        out = plate * plate_mask + bg * (1.0 - plate_mask)
+
+    with profiler.stage("resize"):
+        out = cv2.resize(out, (OUTPUT_SHAPE[1], OUTPUT_SHAPE[0]))
+
+    with profiler.stage("noise"):
+        out += numpy.random.normal(scale=0.05, size=out.shape)
+        out = numpy.clip(out, 0., 1.)
+
+    return out, code, not out_of_bounds
 
-    out = plate * plate_mask + bg * (1.0 - plate_mask)
 
-    out = cv2.resize(out, (OUTPUT_SHAPE[1], OUTPUT_SHAPE[0]))
+class GlyphAtlas(object):
+    """
+    The character images of one font, read from the glyph cache.
 
-    out += numpy.random.normal(scale=0.05, size=out.shape)
-    out = numpy.clip(out, 0., 1.)
+    The images are packed into a single float32 array, and an index gives
+    the character, offset, height and width of each. Neither is read until a
+    character is first looked up, and the packed array is memory-mapped, so
+    that processes using the same font share a single read-only copy.
 
-    return out, code, not out_of_bounds
+    """
 
+    def __init__(self, glyphs_fname, index_fname):
+        self.glyphs_fname = glyphs_fname
+        self.index_fname = index_fname
+        self._char_ims = None
+
+    def _load(self):
+        glyphs = numpy.load(self.glyphs_fname, mmap_mode='r')
+        self._char_ims = {
+            chr(c): glyphs[offset:offset + height * width].reshape(height,
+                                                                   width)
+            for c, offset, height, width in numpy.load(self.index_fname)}
+
+    def __getitem__(self, c):
+        if self._char_ims is None:
+            self._load()
+        return self._char_ims[c]
+
+
+def _write_atlas(glyphs_fname, index_fname, char_ims):
+    # The index is written last, so its presence means the atlas is complete.
+    # Files are written under temporary names unique to this process, so that
+    # processes caching the same font at once do not interfere.
+    index = []
+    offset = 0
+    for c, im in char_ims:
+        index.append((ord(c), offset) + im.shape)
+        offset += im.size
+    glyphs = numpy.concatenate([im.ravel() for c, im in char_ims])
+
+    for fname, a in ((glyphs_fname, glyphs.astype(numpy.float32)),
+                     (index_fname, numpy.array(index, dtype=numpy.int64))):
+        tmp_fname = "{}.{}.tmp".format(fname, os.getpid())
+        with open(tmp_fname, "wb") as f:
+            numpy.save(f, a)
+        os.rename(tmp_fname, fname)
+
+
+def _cached_char_ims(font_path, output_height, cache_dir):
+    # Character images of a font, from the glyph cache if present. Otherwise
+    # they are rendered and added to the cache. If the cache cannot be
+    # written, the rendered images are used directly.
+    with open(font_path, "rb") as f:
+        key = "{}_{}".format(hashlib.sha1(f.read()).hexdigest(),
+                             output_height)
+    glyphs_fname = os.path.join(cache_dir, key + ".glyphs.npy")
+    index_fname = os.path.join(cache_dir, key + ".index.npy")
+
+    if not os.path.exists(index_fname):
+        char_ims = list(make_char_ims(font_path, output_height))
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            _write_atlas(glyphs_fname, index_fname, char_ims)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Could not cache glyphs of {}: {}".format(
+                                                                font_path, e)
+            return dict(char_ims)
+
+    return GlyphAtlas(glyphs_fname, index_fname)
+
+
+def load_fonts(folder_path, cache_dir=None):
+    """
+    Load the character images of each font in a directory.
 
-def load_fonts(folder_path):
+    The images are cached, keyed by the contents of the font file and
+    `FONT_HEIGHT`, so each font is only rendered once.
+
+    :param folder_path:
+        Directory containing `.ttf` fonts.
+
+    :param cache_dir:
+        (Optional.) Directory of the glyph cache. By default this is
+        `GLYPH_CACHE_DIR` within `folder_path`.
+
+    :return:
+        Pair `fonts, font_char_ims`, where `fonts` is a list of font file
+        names, and `font_char_ims` maps each font file name to a mapping from
+        characters to images.
+
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(folder_path, GLYPH_CACHE_DIR)
     font_char_ims = {}
     fonts = [f for f in os.listdir(folder_path) if f.endswith('.ttf')]
     for font in fonts:
-        font_char_ims[font] = dict(make_char_ims(os.path.join(folder_path,
-                                                              font),
-                                                 FONT_HEIGHT))
+        font_char_ims[font] = _cached_char_ims(os.path.join(folder_path, font),
+                                               FONT_HEIGHT, cache_dir)
     return fonts, font_char_ims
 
 
-def generate_ims():
+def generate_ims(font_dir=FONT_DIR, bg_dir="bgs",
+                 profiler=common.NULL_PROFILER, bank_dir=BANK_DIR):
     """
     Generate number plate images.
 
+    :param font_dir:
+        Directory containing the `.ttf` fonts to draw plates with.
+
+    :param bg_dir:
+        Directory containing the background images, as written by
+        `extractbgs.py`. Only used if there is no background bank.
+
+    :param bank_dir:
+        Directory containing a background bank, as written by `bgbank.py`. If
+        it exists, backgrounds are cropped from the bank rather than read from
+        `bg_dir`.
+
+    :param profiler:
+        (Optional.) `common.Profiler` to record the time spent in each stage
+        of generation.
+
     :return:
         Iterable of number plate images.
 
     """
     variation = 1.0
-    fonts, font_char_ims = load_fonts(FONT_DIR)
-    num_bg_images = len(os.listdir("bgs"))
+    fonts, font_char_ims = load_fonts(font_dir)
+    if bgbank.is_bank(bank_dir):
+        bank = bgbank.BackgroundBank(bank_dir)
+        num_bg_images = len(bank)
+    else:
+        bank = None
+        num_bg_images = len(os.listdir(bg_dir))
     while True:
-        yield generate_im(font_char_ims[random.choice(fonts)], num_bg_images)
+        yield generate_im(font_char_ims[random.choice(fonts)], num_bg_images,
+                          bg_dir, profiler, bank)
+
+
+def _benchmark_worker(args):
+    # Runs in a worker process. Generates `num_ims` images, returning the
+    # profiler's records and the time taken, excluding loading the fonts.
+    num_ims, seed, font_dir, bg_dir, bank_dir = args
+    random.seed(seed)
+    numpy.random.seed(seed)
+    profiler = common.Profiler()
+    im_gen = generate_ims(font_dir, bg_dir, profiler, bank_dir)
+    next(im_gen)
+    profiler.reset()
+
+    start = time.time()
+    for _ in itertools.islice(im_gen, num_ims):
+        pass
+    return profiler.records(), time.time() - start
+
+
+def benchmark(num_ims, seed=0, font_dir=FONT_DIR, bg_dir="bgs",
+              bank_dir=BANK_DIR, processes=1):
+    """
+    Time the generation of images.
+
+    :param num_ims:
+        Number of images to generate in each process.
+
+    :param seed:
+        Seed for the `random` and `numpy.random` generators. Process `i` uses
+        `seed + i`, so that processes generate different images, and runs with
+        the same arguments generate the same images.
+
+    :param processes:
+        Number of processes to generate images in. With one process, images
+        are generated in the calling process.
+
+    :returns:
+        Pair `throughput, profiler`, where `throughput` is the total number of
+        images generated per second, and `profiler` is a `common.Profiler`
+        holding the time spent in each stage, summed over the processes.
+
+    """
+    work = [(num_ims, seed + i, font_dir, bg_dir, bank_dir)
+                for i in range(processes)]
+    if processes == 1:
+        results = [_benchmark_worker(work[0])]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_benchmark_worker, work)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    profiler = common.Profiler()
+    for records, elapsed in results:
+        profiler.merge(records)
+    return (num_ims * processes /
+                max(elapsed for records, elapsed in results)), profiler
 
 
 if __name__ == "__main__":
-    os.mkdir("test")
-    im_gen = itertools.islice(generate_ims(), int(sys.argv[1]))
-    for img_idx, (im, c, p) in enumerate(im_gen):
-        fname = "test/{:08d}_{}_{}.png".format(img_idx, c,
-                                               "1" if p else "0")
-        print fname
-        cv2.imwrite(fname, im * 255.)
+    parser = argparse.ArgumentParser(
+                        description="Generate training and test images.")
+    parser.add_argument("num_ims", type=int,
+                        help="Number of images to generate (per process, "
+                             "with --bench).")
+    parser.add_argument("--bench", action="store_true",
+                        help="Time generation and report the time spent in "
+                             "each stage, rather than writing images to "
+                             "test/.")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="With --bench, number of processes to generate "
+                             "images in.")
+    parser.add_argument("--seed", type=int,
+                        help="Random seed. With --bench the default is 0.")
+    parser.add_argument("--font-dir", default=FONT_DIR)
+    parser.add_argument("--bg-dir", default="bgs")
+    parser.add_argument("--bank-dir", default=BANK_DIR,
+                        help="Background bank built by bgbank.py. If it does "
+                             "not exist, backgrounds are read from --bg-dir.")
+    args = parser.parse_args()
+
+    if args.bench:
+        throughput, profiler = benchmark(
+                        args.num_ims,
+                        seed=0 if args.seed is None else args.seed,
+                        font_dir=args.font_dir,
+                        bg_dir=args.bg_dir,
+                        bank_dir=args.bank_dir,
+                        processes=args.processes)
+        print profiler.format_table()
+        print "images/s: {:.1f}".format(throughput)
+    else:
+        if args.seed is not None:
+            random.seed(args.seed)
+            numpy.random.seed(args.seed)
+        os.mkdir("test")
+        im_gen = itertools.islice(generate_ims(args.font_dir, args.bg_dir,
+                                               bank_dir=args.bank_dir),
+                                  args.num_ims)
+        for img_idx, (im, c, p) in enumerate(im_gen):
+            fname = "test/{:08d}_{}_{}.png".format(img_idx, c,
+                                                   "1" if p else "0")
+            print fname
+            cv2.imwrite(fname, im * 255.)
 
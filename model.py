@@ -28,6 +28,9 @@ Definition of the neural networks.
 __all__ = (
     'get_training_model',
     'get_detect_model',
+    'get_mosaic_detect_model',
+    'get_presence_training_model',
+    'get_sparse_detect_model',
     'WINDOW_SHAPE',
 )
 
@@ -37,7 +40,7 @@ import tensorflow as tf
 import common
 
 
-WINDOW_SHAPE = (64, 128)
+WINDOW_SHAPE = common.WINDOW_SHAPE
 
 
 # Utility functions
@@ -66,32 +69,50 @@ def avg_pool(x, ksize=(2, 2), stride=(2, 2)):
                         strides=[1, stride[0], stride[1], 1], padding='SAME')
 
 
-def convolutional_layers():
+def convolutional_layers(mask=None):
     """
     Get the convolutional layers of the model.
 
+    If `mask` is given it must be a tensor with the same shape as the input.
+    The activations of each layer are then zeroed wherever the (pooled) mask
+    is zero, so that masked out regions behave like the zero padding beyond
+    the image edges.
+
     """
     x = tf.placeholder(tf.float32, [None, None, None])
 
+    def apply_mask(h, m):
+        return h if m is None else h * m
+
+    def pool_mask(m, ksize, stride):
+        return None if m is None else max_pool(m, ksize=ksize, stride=stride)
+
+    m = None if mask is None else tf.expand_dims(mask, 3)
+
     # First layer
     W_conv1 = weight_variable([5, 5, 1, 48])
     b_conv1 = bias_variable([48])
     x_expanded = tf.expand_dims(x, 3)
     h_conv1 = tf.nn.relu(conv2d(x_expanded, W_conv1) + b_conv1)
+    h_conv1 = apply_mask(h_conv1, m)
     h_pool1 = max_pool(h_conv1, ksize=(2, 2), stride=(2, 2))
+    m = pool_mask(m, ksize=(2, 2), stride=(2, 2))
 
     # Second layer
     W_conv2 = weight_variable([5, 5, 48, 64])
     b_conv2 = bias_variable([64])
 
     h_conv2 = tf.nn.relu(conv2d(h_pool1, W_conv2) + b_conv2)
+    h_conv2 = apply_mask(h_conv2, m)
     h_pool2 = max_pool(h_conv2, ksize=(2, 1), stride=(2, 1))
+    m = pool_mask(m, ksize=(2, 1), stride=(2, 1))
 
     # Third layer
     W_conv3 = weight_variable([5, 5, 64, 128])
     b_conv3 = bias_variable([128])
 
     h_conv3 = tf.nn.relu(conv2d(h_pool2, W_conv3) + b_conv3)
+    h_conv3 = apply_mask(h_conv3, m)
     h_pool3 = max_pool(h_conv3, ksize=(2, 2), stride=(2, 2))
 
     return x, h_pool3, [W_conv1, b_conv1,
@@ -99,7 +120,53 @@ def convolutional_layers():
                         W_conv3, b_conv3]
 
 
-def get_training_model():
+def _fc_weights(n_in, n_out, rank=None):
+    # Weights of a fully connected layer. If `rank` is given the weight matrix
+    # is factorized into a pair of matrices, with `rank` columns and rows
+    # respectively, whose product is used in place of the full matrix.
+    if rank is None:
+        return [weight_variable([n_in, n_out])]
+    else:
+        return [weight_variable([n_in, rank]), weight_variable([rank, n_out])]
+
+
+def _fc_matmul(h, weights):
+    for W in weights:
+        h = tf.matmul(h, W)
+    return h
+
+
+def _fc_conv(h, weights, ksize):
+    # Apply a (possibly factorized) fully connected layer to each `ksize`
+    # window of `h`. The first matrix is applied as a `ksize` convolution, and
+    # the second, if any, as a 1x1 convolution.
+    for W in weights:
+        n_in, n_out = W.get_shape().as_list()
+        W_conv = tf.reshape(W, [ksize[0], ksize[1],
+                                n_in // (ksize[0] * ksize[1]), n_out])
+        h = conv2d(h, W_conv, stride=(1, 1), padding="VALID")
+        ksize = (1, 1)
+    return h
+
+
+def _training_layers(conv_layer, fc1_rank=None, fc2_rank=None):
+    # Densely connected layer
+    W_fc1 = _fc_weights(32 * 8 * 128, 2048, fc1_rank)
+    b_fc1 = bias_variable([2048])
+
+    conv_layer_flat = tf.reshape(conv_layer, [-1, 32 * 8 * 128])
+    h_fc1 = tf.nn.relu(_fc_matmul(conv_layer_flat, W_fc1) + b_fc1)
+
+    # Output layer
+    W_fc2 = _fc_weights(2048, 1 + 7 * len(common.CHARS), fc2_rank)
+    b_fc2 = bias_variable([1 + 7 * len(common.CHARS)])
+
+    y = _fc_matmul(h_fc1, W_fc2) + b_fc2
+
+    return y, W_fc1 + [b_fc1] + W_fc2 + [b_fc2]
+
+
+def get_training_model(fc1_rank=None, fc2_rank=None):
     """
     The training model acts on a batch of 128x64 windows, and outputs a (1 +
     7 * len(common.CHARS) vector, `v`. `v[0]` is the probability that a plate is
@@ -108,47 +175,153 @@ def get_training_model():
     `v[1 + i * len(common.CHARS) + c]` is the probability that the `i`'th
     character is `c`.
 
+    If `fc1_rank` (or `fc2_rank`) is given, the weights of the first (or
+    second) fully connected layer are factorized into a pair of matrices of
+    the given rank. See `factorize.py`.
+
     """
     x, conv_layer, conv_vars = convolutional_layers()
-    
-    # Densely connected layer
-    W_fc1 = weight_variable([32 * 8 * 128, 2048])
-    b_fc1 = bias_variable([2048])
+    y, fc_vars = _training_layers(conv_layer, fc1_rank, fc2_rank)
+
+    return (x, y, conv_vars + fc_vars)
+
+
+# Width of the hidden layer of the presence head. This is small compared with
+# the 2048 units of the full model's first fully connected layer.
+PRESENCE_HEAD_UNITS = 64
+
+
+def _presence_training_layers(conv_layer):
+    W_p1 = weight_variable([32 * 8 * 128, PRESENCE_HEAD_UNITS])
+    b_p1 = bias_variable([PRESENCE_HEAD_UNITS])
 
     conv_layer_flat = tf.reshape(conv_layer, [-1, 32 * 8 * 128])
-    h_fc1 = tf.nn.relu(tf.matmul(conv_layer_flat, W_fc1) + b_fc1)
+    h_p1 = tf.nn.relu(tf.matmul(conv_layer_flat, W_p1) + b_p1)
 
-    # Output layer
-    W_fc2 = weight_variable([2048, 1 + 7 * len(common.CHARS)])
-    b_fc2 = bias_variable([1 + 7 * len(common.CHARS)])
+    W_p2 = weight_variable([PRESENCE_HEAD_UNITS, 1])
+    b_p2 = bias_variable([1])
 
-    y = tf.matmul(h_fc1, W_fc2) + b_fc2
+    y = tf.matmul(h_p1, W_p2) + b_p2
 
-    return (x, y, conv_vars + [W_fc1, b_fc1, W_fc2, b_fc2])
+    return y, [W_p1, b_p1, W_p2, b_p2]
 
 
-def get_detect_model():
+def _presence_detect_layers(conv_layer):
+    W_p1 = weight_variable([8 * 32 * 128, PRESENCE_HEAD_UNITS])
+    W_conv1 = tf.reshape(W_p1, [8, 32, 128, PRESENCE_HEAD_UNITS])
+    b_p1 = bias_variable([PRESENCE_HEAD_UNITS])
+    h_conv1 = tf.nn.relu(conv2d(conv_layer, W_conv1,
+                                stride=(1, 1), padding="VALID") + b_p1)
+
+    W_p2 = weight_variable([PRESENCE_HEAD_UNITS, 1])
+    W_conv2 = tf.reshape(W_p2, [1, 1, PRESENCE_HEAD_UNITS, 1])
+    b_p2 = bias_variable([1])
+    h_conv2 = conv2d(h_conv1, W_conv2) + b_p2
+
+    return h_conv2, [W_p1, b_p1, W_p2, b_p2]
+
+
+def get_presence_training_model():
     """
-    The same as the training model, except it acts on an arbitrarily sized
-    input, and slides the 128x64 window across the image in 8x8 strides.
+    A cheap model which only predicts whether a plate is present.
 
-    The output is of the form `v`, where `v[i, j]` is equivalent to the output
-    of the training model, for the window at coordinates `(8 * i, 4 * j)`.
+    It shares the convolutional layers of the training model, followed by a
+    narrow fully connected layer. The output is a single value per window,
+    equivalent to `v[0]` of the training model.
+
+    Returns `x, y, conv_vars, presence_vars`, where `conv_vars` are the
+    parameters of the convolutional layers, which are shared with the full
+    model, and `presence_vars` are the parameters specific to this model.
 
     """
     x, conv_layer, conv_vars = convolutional_layers()
-    
+    y, presence_vars = _presence_training_layers(conv_layer)
+
+    return (x, y, conv_vars, presence_vars)
+
+
+def _detect_layers(conv_layer, fc1_rank=None, fc2_rank=None):
     # Fourth layer
-    W_fc1 = weight_variable([8 * 32 * 128, 2048])
-    W_conv1 = tf.reshape(W_fc1, [8,  32, 128, 2048])
+    W_fc1 = _fc_weights(8 * 32 * 128, 2048, fc1_rank)
     b_fc1 = bias_variable([2048])
-    h_conv1 = tf.nn.relu(conv2d(conv_layer, W_conv1,
-                                stride=(1, 1), padding="VALID") + b_fc1) 
+    h_conv1 = tf.nn.relu(_fc_conv(conv_layer, W_fc1, (8, 32)) + b_fc1)
+
     # Fifth layer
-    W_fc2 = weight_variable([2048, 1 + 7 * len(common.CHARS)])
-    W_conv2 = tf.reshape(W_fc2, [1, 1, 2048, 1 + 7 * len(common.CHARS)])
+    W_fc2 = _fc_weights(2048, 1 + 7 * len(common.CHARS), fc2_rank)
     b_fc2 = bias_variable([1 + 7 * len(common.CHARS)])
-    h_conv2 = conv2d(h_conv1, W_conv2) + b_fc2
+    h_conv2 = _fc_conv(h_conv1, W_fc2, (1, 1)) + b_fc2
+
+    return h_conv2, W_fc1 + [b_fc1] + W_fc2 + [b_fc2]
+
+
+def get_detect_model(fc1_rank=None, fc2_rank=None):
+    """
+    The same as the training model, except it acts on an arbitrarily sized
+    input, and slides the 128x64 window across the image in 8x8 strides.
+
+    The output is of the form `v`, where `v[i, j]` is equivalent to the output
+    of the training model, for the window at coordinates `(8 * i, 4 * j)`.
+
+    `fc1_rank` and `fc2_rank` are as for `get_training_model`.
+
+    """
+    x, conv_layer, conv_vars = convolutional_layers()
+    y, fc_vars = _detect_layers(conv_layer, fc1_rank, fc2_rank)
+
+    return (x, y, conv_vars + fc_vars)
+
+
+def get_mosaic_detect_model(fc1_rank=None, fc2_rank=None):
+    """
+    The same as the detect model, except it additionally takes a mask with the
+    same shape as the input. The mask should be 1 over the images packed into
+    the input, and 0 elsewhere.
+
+    Provided the packed images are at offsets which are multiples of 8 pixels,
+    and are separated by gaps of zeros at least 8 pixels wide, the windows of
+    the output which lie within a packed image are identical to the output
+    that the detect model would give for that image alone.
+
+    Returns `x, mask, y, params`.
+
+    """
+    mask = tf.placeholder(tf.float32, [None, None, None])
+    x, conv_layer, conv_vars = convolutional_layers(mask)
+    y, fc_vars = _detect_layers(conv_layer, fc1_rank, fc2_rank)
+
+    return (x, mask, y, conv_vars + fc_vars)
+
+
+def get_sparse_detect_model(fc1_rank=None, fc2_rank=None):
+    """
+    A two stage detect model, which evaluates the full model only where the
+    presence model predicts a plate may be present.
+
+    The first stage slides the presence model (see
+    `get_presence_training_model`) across an arbitrarily sized input, in the
+    same way as the detect model. The second stage applies the fully connected
+    layers of the training model to patches of the convolutional layers'
+    output, at the positions accepted by the first stage.
+
+    Returns `x, conv_layer, presence, patches, y, params, presence_params`:
+      - `x` is the input image batch.
+      - `conv_layer` is the output of the convolutional layers.
+      - `presence` is the output of the presence model, such that
+        `presence[n, i, j, 0]` is the presence logit for the window at
+        coordinates `(8 * i, 4 * j)` of the `n`th image.
+      - `patches` is a batch of 8x32x128 patches cut from `conv_layer`, each
+        of which corresponds with a single window.
+      - `y` is the output of the training model for each patch.
+      - `params` are parameters of the same form as the training model's.
+      - `presence_params` are the presence model's parameters, other than
+        those shared with `params`.
+
+    """
+    x, conv_layer, conv_vars = convolutional_layers()
+    presence, presence_vars = _presence_detect_layers(conv_layer)
 
-    return (x, h_conv2, conv_vars + [W_fc1, b_fc1, W_fc2, b_fc2])
+    patches = tf.placeholder(tf.float32, [None, 8, 32, 128])
+    y, fc_vars = _training_layers(patches, fc1_rank, fc2_rank)
 
+    return (x, conv_layer, presence, patches, y, conv_vars + fc_vars,
+            presence_vars)
@@ -0,0 +1,184 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+A NumPy implementation of the detect model.
+
+This evaluates the same function as `model.get_detect_model`, with the same
+parameters, but does not depend on TensorFlow. Convolutions are computed as
+matrix multiplications of image patches, so the speed is determined by the
+BLAS library NumPy is linked against.
+
+The model is expressed as a sequence of layers (see `detect_layers`), each of
+which correlates its input with a kernel, adds a bias, and is optionally
+followed by a ReLU and a max pool. The fully connected layers are applied as
+convolutions over the output of the convolutional layers, as in the detect
+model.
+
+"""
+
+
+__all__ = (
+    'detect_layers',
+    'forward',
+)
+
+
+import numpy
+
+import common
+
+
+# Pooling applied after each of the convolutional layers.
+_POOLS = ((2, 2), (2, 1), (2, 2))
+
+
+def detect_layers(param_vals):
+    """
+    Express the detect model as a sequence of layers.
+
+    :param param_vals:
+        Model parameters, as output by `train.train` or `factorize.py`.
+
+    :return:
+        List of dicts, one per layer, with keys:
+          - `W`: Kernel of shape `kh, kw, in_channels, out_channels`.
+          - `b`: Bias to add to the output, or `None`.
+          - `pad`: Number of zeros to pad each side of the input with.
+          - `relu`: Whether a ReLU is applied to the output.
+          - `pool`: Size (and stride) of a max pool to apply to the output,
+            or `None`.
+
+    """
+    layers = []
+    for i, pool in enumerate(_POOLS):
+        layers.append(dict(W=param_vals[2 * i], b=param_vals[2 * i + 1],
+                           pad=2, relu=True, pool=pool))
+
+    # The fully connected layers, each of which may be factorized into a pair
+    # of matrices. The first matrix of the first layer is applied to 8x32
+    # windows, and the rest to single positions.
+    vals = list(param_vals[6:])
+    ksize = (common.WINDOW_SHAPE[0] // 8, common.WINDOW_SHAPE[1] // 4)
+    for rank, relu in zip(common.fc_ranks(param_vals), (True, False)):
+        weights = vals[:1] if rank is None else vals[:2]
+        b = vals[len(weights)]
+        vals = vals[len(weights) + 1:]
+        for j, W in enumerate(weights):
+            n_in, n_out = W.shape
+            last = j == len(weights) - 1
+            layers.append(dict(W=W.reshape(ksize[0], ksize[1],
+                                           n_in // (ksize[0] * ksize[1]),
+                                           n_out),
+                               b=b if last else None,
+                               pad=0,
+                               relu=relu and last,
+                               pool=None))
+            ksize = (1, 1)
+
+    return layers
+
+
+def _correlate(h, W, max_patch_elements=1 << 23):
+    # Correlate a batch of feature maps `h` with a kernel `W` of shape
+    # `kh, kw, c, k`, without padding. The product is computed as one matrix
+    # multiplication per kernel row, over blocks of output rows small enough
+    # that the patches copied for each multiplication have at most
+    # `max_patch_elements` elements.
+    kh, kw, c, k = W.shape
+    n, rows, cols, _ = h.shape
+    out_rows, out_cols = max(0, rows - kh + 1), max(0, cols - kw + 1)
+    out = numpy.zeros((n, out_rows, out_cols, k), dtype=numpy.float32)
+
+    h = numpy.ascontiguousarray(h, dtype=numpy.float32)
+    W = W.reshape(kh, kw * c, k)
+    block_rows = max(1, max_patch_elements // max(1, out_cols * kw * c))
+    for im_idx in range(n):
+        for start in range(0, out_rows, block_rows):
+            stop = min(out_rows, start + block_rows)
+            block = out[im_idx, start:stop].reshape(-1, k)
+            for i in range(kh):
+                patches = numpy.lib.stride_tricks.as_strided(
+                            h[im_idx, start + i:],
+                            shape=(stop - start, out_cols, kw, c),
+                            strides=h.strides[1:3] + h.strides[2:])
+                block += numpy.dot(patches.reshape(-1, kw * c), W[i])
+
+    return out
+
+
+def _max_pool(h, ksize):
+    # Max pool with stride equal to the pool size. As with TensorFlow's SAME
+    # padding, the output has `ceil(rows / ksize[0])` rows. The input must be
+    # non-negative, so padding with zeros does not affect the result.
+    n, rows, cols, c = h.shape
+    out_rows = -(-rows // ksize[0])
+    out_cols = -(-cols // ksize[1])
+    if (out_rows * ksize[0], out_cols * ksize[1]) != (rows, cols):
+        padded = numpy.zeros((n, out_rows * ksize[0], out_cols * ksize[1], c),
+                             dtype=h.dtype)
+        padded[:, :rows, :cols] = h
+        h = padded
+    h = h.reshape(n, out_rows, ksize[0], out_cols, ksize[1], c)
+    return h.max(axis=(2, 4))
+
+
+def forward(x, layers, quantize_input=None):
+    """
+    Evaluate a sequence of layers on a batch of images.
+
+    :param x:
+        Batch of grayscale images, with shape `n, rows, cols`.
+
+    :param layers:
+        Layers, as returned by `detect_layers`.
+
+    :param quantize_input:
+        (Optional.) Function called as `quantize_input(i, h)` with the input
+        `h` to the `i`th layer. It returns the values to pass to the layer in
+        place of `h`, and a scale by which the layer's output (before the bias
+        is added) is multiplied. See `quantize.QuantizedDetector`.
+
+    :return:
+        The output of the final layer. For the layers of the detect model this
+        is the same as the output of `model.get_detect_model`.
+
+    """
+    h = x[..., numpy.newaxis].astype(numpy.float32)
+    for i, layer in enumerate(layers):
+        if quantize_input is not None:
+            h, scale = quantize_input(i, h)
+        else:
+            scale = None
+        if layer['pad']:
+            p = layer['pad']
+            h = numpy.pad(h, ((0, 0), (p, p), (p, p), (0, 0)),
+                          mode='constant')
+        h = _correlate(h, layer['W'])
+        if scale is not None:
+            h *= scale
+        if layer['b'] is not None:
+            h += layer['b']
+        if layer['relu']:
+            numpy.maximum(h, 0, out=h)
+        if layer['pool'] is not None:
+            h = _max_pool(h, layer['pool'])
+    return h
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Post-training int8 quantization, and simulated quantized inference.
+
+The weights of each layer are quantized to int8 with one scale per output
+channel, and the input activations of each layer to int8 with one scale per
+layer. Activation scales are calibrated by running the float model over
+windows from `gen.generate_ims`.
+
+`QuantizedDetector` simulates a quantized model, to measure the accuracy lost
+by quantization: each layer's input is rounded to the int8 grid, multiplied
+by the int8 weights, rescaled and has the float bias added. Since neither
+NumPy nor TensorFlow provide a fast int8 matrix multiplication on the CPU, the
+int8 values are held as float32 and multiplied with NumPy's float32 matrix
+multiplication. Sums of more than 2 ** 24 / 127 ** 2 (about 1000) products,
+as in every layer but the first, are therefore rounded as in float32 rather
+than being exact integers. The simulation uses no less memory and is no faster
+than the float model; the only saving is the quantized weights file, a
+quarter of the size.
+
+`calibrate` writes a quantized weights file, and `evaluate` reports the
+accuracy and speed of a quantized weights file relative to the float model.
+
+"""
+
+
+__all__ = (
+    'QuantizedDetector',
+    'calibrate',
+    'load_quantized',
+    'quantize',
+    'save_quantized',
+)
+
+
+import argparse
+import itertools
+import time
+
+import cv2
+import numpy
+
+import common
+import detect
+import gen
+import npmodel
+import weightstore
+
+
+_INT8_MAX = 127
+
+
+def calibrate(param_vals, ims, percentile=99.99, batch_size=50,
+              max_samples=1000000):
+    """
+    Calibrate the ranges of the input activations of each layer.
+
+    :param param_vals:
+        Float model parameters.
+
+    :param ims:
+        Iterable of 64x128 windows to calibrate with, such as those produced
+        by `gen.generate_ims`.
+
+    :param percentile:
+        Percentile of each layer's absolute input values to take as the range
+        of its input. Values beyond the range are clipped when quantized.
+
+    :param batch_size:
+        Number of windows to evaluate at once.
+
+    :param max_samples:
+        The percentile is taken over a uniform random sample of at most this
+        many of each layer's input values, to bound memory use.
+
+    :return:
+        List containing the range of each layer's input.
+
+    """
+    layers = npmodel.detect_layers(param_vals)
+    rng = numpy.random.RandomState(0)
+    samples = [numpy.zeros((0,), dtype=numpy.float32) for layer in layers]
+    sample_keys = [numpy.zeros((0,)) for layer in layers]
+
+    def record_input(i, h):
+        # Reservoir sampling: each value gets a random key, and the values
+        # with the smallest `max_samples` keys seen so far are kept.
+        values = numpy.concatenate([samples[i], numpy.abs(h).ravel()])
+        keys = numpy.concatenate([sample_keys[i], rng.rand(h.size)])
+        if len(values) > max_samples:
+            keep = numpy.argpartition(keys, max_samples)[:max_samples]
+            values, keys = values[keep], keys[keep]
+        samples[i], sample_keys[i] = values, keys
+        return h, 1.
+
+    ims = iter(ims)
+    while True:
+        batch = list(itertools.islice(ims, batch_size))
+        if not batch:
+            break
+        npmodel.forward(numpy.stack(batch), layers, record_input)
+
+    return [float(numpy.percentile(s, percentile)) for s in samples]
+
+
+def quantize(param_vals, input_ranges):
+    """
+    Quantize a set of model parameters.
+
+    :param param_vals:
+        Float model parameters, factorized or otherwise.
+
+    :param input_ranges:
+        Range of each layer's input, as returned by `calibrate`.
+
+    :return:
+        List of quantized layers, as accepted by `QuantizedDetector`.
+
+    """
+    qlayers = []
+    for layer, input_range in zip(npmodel.detect_layers(param_vals),
+                                  input_ranges):
+        W = layer['W']
+        W_scale = numpy.max(numpy.abs(W.reshape(-1, W.shape[-1])), axis=0)
+        W_scale = numpy.maximum(W_scale, 1e-12) / _INT8_MAX
+        qlayer = dict(layer)
+        qlayer['W'] = numpy.round(W / W_scale).astype(numpy.int8)
+        qlayer['W_scale'] = W_scale.astype(numpy.float32)
+        qlayer['x_scale'] = max(input_range, 1e-12) / _INT8_MAX
+        qlayers.append(qlayer)
+
+    return qlayers
+
+
+_LAYER_KEYS = ('W', 'b', 'W_scale', 'x_scale', 'pad', 'relu', 'pool')
+
+
+def save_quantized(fname, qlayers):
+    """
+    Write quantized layers, as returned by `quantize`, to an `.npz` file.
+
+    """
+    arrays = {}
+    for i, qlayer in enumerate(qlayers):
+        for key in _LAYER_KEYS:
+            if qlayer[key] is not None:
+                arrays["{}_{}".format(key, i)] = numpy.asarray(qlayer[key])
+    numpy.savez(fname, num_layers=len(qlayers), **arrays)
+
+
+def load_quantized(fname):
+    """
+    Read quantized layers written by `save_quantized`.
+
+    """
+    f = numpy.load(fname)
+    qlayers = []
+    for i in range(int(f['num_layers'])):
+        qlayer = {}
+        for key in _LAYER_KEYS:
+            name = "{}_{}".format(key, i)
+            qlayer[key] = f[name] if name in f.files else None
+        qlayer['pad'] = int(qlayer['pad'])
+        qlayer['relu'] = bool(qlayer['relu'])
+        qlayer['x_scale'] = float(qlayer['x_scale'])
+        if qlayer['pool'] is not None:
+            qlayer['pool'] = tuple(qlayer['pool'])
+        qlayers.append(qlayer)
+    return qlayers
+
+
+class QuantizedDetector(detect.Detector):
+    """
+    A `detect.Detector` which simulates a quantized model.
+
+    Scale search, batching, masked and coarse-to-fine search, and
+    post-processing all behave as for `detect.Detector`. Mosaic mode and
+    presence models are not supported.
+
+    """
+
+    def __init__(self, qlayers, scale_ratio=1. / 2 ** 0.5,
+                 min_plate_width=None, max_plate_width=None, roi=None):
+        """
+        :param qlayers:
+            Quantized layers, as returned by `quantize` or `load_quantized`.
+
+        :param scale_ratio:
+            Ratio between the sizes of consecutive scales that images are
+            searched at.
+
+        :param min_plate_width:
+            As for `detect.Detector`.
+
+        :param max_plate_width:
+            As for `detect.Detector`.
+
+        :param roi:
+            As for `detect.Detector`.
+
+        """
+        self._mosaic = False
+        self._sparse = False
+        self._sess = None
+        self._init_search(scale_ratio, min_plate_width, max_plate_width, roi)
+
+        # The int8 weights are held as float32, so that the products can be
+        # summed with a float32 matrix multiplication (see the module
+        # docstring).
+        self._layers = []
+        for qlayer in qlayers:
+            layer = dict(qlayer)
+            layer['W'] = qlayer['W'].astype(numpy.float32)
+            layer['scale'] = qlayer['x_scale'] * qlayer['W_scale']
+            self._layers.append(layer)
+
+    def _quantize_input(self, i, h):
+        layer = self._layers[i]
+        q = numpy.round(h / layer['x_scale'])
+        numpy.clip(q, -_INT8_MAX, _INT8_MAX, out=q)
+        return q, layer['scale']
+
+    def _run(self, batch):
+        return npmodel.forward(batch, self._layers, self._quantize_input)
+
+
+def _accuracy(y_val, test_ys):
+    # As in `train.train`, the characters of windows correctly predicted to not
+    # contain a plate are not considered.
+    def best(v):
+        return numpy.argmax(v[:, 1:].reshape(-1, 7, len(common.CHARS)), 2)
+
+    present = y_val[:, 0] > 0
+    presence_correct = present == (test_ys[:, 0] > 0.5)
+    correct = presence_correct & (~present |
+                                  numpy.all(best(y_val) == best(test_ys), 1))
+    return numpy.mean(correct), numpy.mean(presence_correct)
+
+
+def _time_search(detector, im, reps):
+    detector.find_matches([im])
+    start = time.time()
+    for _ in range(reps):
+        detector.find_matches([im])
+    return (time.time() - start) / reps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Int8 quantization.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    calibrate_parser = subparsers.add_parser(
+                        "calibrate",
+                        help="Calibrate and write quantized weights.")
+    calibrate_parser.add_argument("weights", help="Float weights file.")
+    calibrate_parser.add_argument("output",
+                                  help="Where to write the quantized "
+                                       "weights.")
+    calibrate_parser.add_argument("--num-ims", type=int, default=1000,
+                                  help="Number of generated windows to "
+                                       "calibrate with.")
+    calibrate_parser.add_argument("--percentile", type=float, default=99.99)
+
+    evaluate_parser = subparsers.add_parser(
+                        "evaluate",
+                        help="Compare quantized weights with the float "
+                             "weights they were made from.")
+    evaluate_parser.add_argument("weights", help="Float weights file.")
+    evaluate_parser.add_argument("quantized_weights",
+                                 help="Quantized weights file.")
+    evaluate_parser.add_argument("--test-glob", default="test/*.png",
+                                 help="Labelled windows, as output by "
+                                      "gen.py.")
+    evaluate_parser.add_argument("--image",
+                                 help="Image to time detection with. By "
+                                      "default a random 240x320 image is "
+                                      "used.")
+    evaluate_parser.add_argument("--reps", type=int, default=3)
+
+    args = parser.parse_args()
+
+    param_vals = weightstore.load_weights(args.weights)
+
+    if args.command == "calibrate":
+        ims = (im for im, code, p in itertools.islice(gen.generate_ims(),
+                                                      args.num_ims))
+        input_ranges = calibrate(param_vals, ims, percentile=args.percentile)
+        save_quantized(args.output, quantize(param_vals, input_ranges))
+    elif args.command == "evaluate":
+        import train
+        test_xs, test_ys = train.unzip(list(train.read_data(args.test_glob)))
+        if args.image is not None:
+            im = cv2.cvtColor(cv2.imread(args.image),
+                              cv2.COLOR_BGR2GRAY) / 255.
+        else:
+            im = numpy.random.RandomState(0).rand(240, 320)
+
+        qdetector = QuantizedDetector(load_quantized(args.quantized_weights))
+        with detect.Detector(param_vals) as detector:
+            results = []
+            for name, d in (("float", detector), ("int8", qdetector)):
+                y_val = d._run(test_xs).reshape(len(test_xs), -1)
+                results.append((name,) + _accuracy(y_val, test_ys) +
+                               (_time_search(d, im, args.reps),))
+
+        print "{:>6} {:>9} {:>9} {:>9}".format("model", "accuracy",
+                                               "presence", "time (s)")
+        for name, accuracy, presence_accuracy, t in results:
+            print "{:>6} {:8.2f}% {:8.2f}% {:9.3f}".format(
+                        name, 100. * accuracy, 100. * presence_accuracy, t)
+        print "accuracy delta: {:+.2f}%".format(
+                        100. * (results[1][1] - results[0][1]))
+        print "throughput gain: {:.2f}x".format(results[0][3] / results[1][3])
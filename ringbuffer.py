@@ -0,0 +1,119 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+A fixed pool of shared memory slots, for passing arrays between processes
+without copying them through a pipe.
+
+Each slot holds one float32 array of each of a given set of shapes. A producer
+acquires a free slot, writes its arrays in place, and publishes the slot. A
+consumer gets a published slot, reads its arrays, which are views of the
+shared memory, and releases the slot so that it can be reused. Only slot
+indices pass through queues.
+
+The shared memory is inherited by child processes, so a `RingBuffer` must be
+constructed before the processes which use it are started.
+
+"""
+
+
+__all__ = (
+    'RingBuffer',
+)
+
+
+import ctypes
+import multiprocessing
+
+import numpy
+
+
+class RingBuffer(object):
+    """
+    A fixed pool of shared memory slots. See the module docstring.
+
+    """
+
+    def __init__(self, num_slots, shapes):
+        """
+        :param num_slots:
+            Number of slots. At most this many sets of arrays can be written
+            but not yet released at once.
+
+        :param shapes:
+            Shapes of the arrays in each slot.
+
+        """
+        self.num_slots = num_slots
+        self._views = []
+        for shape in shapes:
+            raw = multiprocessing.RawArray(ctypes.c_float,
+                                           num_slots * int(numpy.prod(shape)))
+            self._views.append(numpy.frombuffer(raw, dtype=numpy.float32)
+                                   .reshape((num_slots,) + tuple(shape)))
+
+        self._free = multiprocessing.Queue()
+        self._full = multiprocessing.Queue()
+        for idx in range(num_slots):
+            self._free.put(idx)
+
+    def arrays(self, idx):
+        """
+        Return views of the arrays in slot `idx`.
+
+        """
+        return tuple(view[idx] for view in self._views)
+
+    def acquire(self):
+        """
+        Wait for a free slot, and return its index and arrays for writing.
+
+        """
+        idx = self._free.get()
+        return idx, self.arrays(idx)
+
+    def publish(self, idx):
+        """
+        Make an acquired slot available to `get`.
+
+        """
+        self._full.put(idx)
+
+    def get(self, block=True):
+        """
+        Return the index and arrays of a published slot, in the order
+        published.
+
+        :param block:
+            If false, raise `Queue.Empty` rather than wait when no slot has
+            been published.
+
+        """
+        idx = self._full.get(block)
+        return idx, self.arrays(idx)
+
+    def release(self, idx):
+        """
+        Return a slot obtained from `get` to the pool, after which its arrays
+        may be overwritten.
+
+        """
+        self._free.put(idx)
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+A long running number plate detection server.
+
+The server keeps a `detect.Detector` loaded, and answers HTTP requests on a
+local port:
+
+  - `POST /detect`, with an encoded image (any format `cv2.imdecode` reads) as
+    the request body, returns a JSON list of the plates found. Each plate is
+    an object with keys `bbox` (`[top, left, bottom, right]` in pixels),
+    `present_prob` and `code`.
+  - `GET /stats` returns a JSON object of request and batch statistics.
+
+Concurrent requests are collected into batches, which are evaluated with a
+single call to `detect.Detector.find_matches`. A batch is evaluated once it
+is full, or once its first request has waited for the maximum latency budget,
+whichever comes first.
+
+Run `./server.py serve weights.npz` to start a server, and `./server.py client
+http://127.0.0.1:8080 in.jpg` to send it images.
+
+"""
+
+
+__all__ = (
+    'BatchStats',
+    'Batcher',
+    'DetectionServer',
+    'request_plates',
+)
+
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import Queue
+import SocketServer
+import sys
+import threading
+import time
+import urllib2
+
+import cv2
+import numpy
+
+import detect
+import weightstore
+
+
+class BatchStats(object):
+    """
+    Running counts of requests and batches handled by a `Batcher`.
+
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.batch_sizes = collections.Counter()
+
+    @property
+    def mean_batch_size(self):
+        return float(self.requests) / max(1, self.batches)
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / max(1, self.requests)
+
+    def as_dict(self):
+        return dict(uptime=time.time() - self.start_time,
+                    requests=self.requests,
+                    batches=self.batches,
+                    errors=self.errors,
+                    mean_batch_size=self.mean_batch_size,
+                    mean_latency=self.mean_latency,
+                    max_latency=self.max_latency,
+                    batch_sizes=dict((str(k), v) for k, v in
+                                         sorted(self.batch_sizes.items())))
+
+
+class _Request(object):
+    def __init__(self, im):
+        self.im = im
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+        self.plates = None
+        self.exc_info = None
+
+
+class Batcher(object):
+    """
+    Collect images submitted from several threads into batches for a
+    detector.
+
+    A single worker thread owns the detector. Each call to `detect` blocks
+    until the batch containing its image has been evaluated. If evaluating an
+    image fails, only the request for that image raises the error.
+
+    """
+
+    def __init__(self, detector, max_batch_size=16, max_latency=0.05):
+        """
+        :param detector:
+            `detect.Detector` to evaluate batches with.
+
+        :param max_batch_size:
+            Largest number of images to evaluate in one batch.
+
+        :param max_latency:
+            Longest time, in seconds, to hold a request while waiting for
+            others to batch it with.
+
+        """
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = BatchStats()
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        """
+        Number of requests waiting to be put into a batch.
+
+        """
+        return self._queue.qsize()
+
+    def detect(self, im):
+        """
+        Detect number plates in a grayscale image.
+
+        :returns:
+            List of plates, each a dict with keys `bbox`, `present_prob` and
+            `code`.
+
+        """
+        request = _Request(im)
+        self._queue.put(request)
+        request.done.wait()
+        if request.exc_info is not None:
+            raise request.exc_info[0], request.exc_info[1], request.exc_info[2]
+        return request.plates
+
+    def stats_dict(self):
+        """
+        Statistics as a JSON serializable dict, including the current queue
+        depth.
+
+        """
+        with self._lock:
+            d = self.stats.as_dict()
+        d['queue_depth'] = self.queue_depth
+        return d
+
+    def close(self):
+        """
+        Stop the worker thread once it has finished the current batch.
+
+        """
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        # Block for the first request, then gather more until the batch is
+        # full or the first request's latency budget is spent.
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.arrival_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    request = self._queue.get(timeout=timeout)
+                else:
+                    request = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _find_matches_one(self, request):
+        # Matches for a single request, or None with the request's
+        # `exc_info` set if evaluating it fails.
+        try:
+            return self.detector.find_matches([request.im])[0]
+        except Exception:
+            request.exc_info = sys.exc_info()
+            return None
+
+    def _run(self):
+        while not self._stopped:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                all_matches = self.detector.find_matches(
+                                                [r.im for r in batch])
+            except Exception:
+                # Evaluate the images one at a time, so that only the
+                # requests whose images fail get an error.
+                all_matches = [self._find_matches_one(r) for r in batch]
+            for request, matches in zip(batch, all_matches):
+                if request.exc_info is not None:
+                    continue
+                try:
+                    request.plates = [detect.match_to_dict(*m) for m in
+                                      self.detector.post_process(matches)]
+                except Exception:
+                    request.exc_info = sys.exc_info()
+
+            now = time.time()
+            with self._lock:
+                self.stats.batches += 1
+                self.stats.batch_sizes[len(batch)] += 1
+                for request in batch:
+                    latency = now - request.arrival_time
+                    self.stats.requests += 1
+                    self.stats.errors += request.exc_info is not None
+                    self.stats.total_latency += latency
+                    self.stats.max_latency = max(self.stats.max_latency,
+                                                 latency)
+            for request in batch:
+                request.done.set()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def _send_json(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.batcher.stats_dict())
+        else:
+            self._send_json(404, dict(error="Not found"))
+
+    def do_POST(self):
+        if self.path != "/detect":
+            self._send_json(404, dict(error="Not found"))
+            return
+
+        data = self.rfile.read(int(self.headers.getheader("Content-Length",
+                                                          0)))
+        im = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8),
+                          cv2.CV_LOAD_IMAGE_GRAYSCALE)
+        if im is None:
+            self._send_json(400, dict(error="Could not decode image"))
+            return
+
+        try:
+            plates = self.server.batcher.detect(im / 255.)
+        except Exception as e:
+            self._send_json(500, dict(error=str(e)))
+            return
+        self._send_json(200, plates)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+
+class DetectionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP server answering detection requests with a `Batcher`.
+
+    Each connection is handled in its own thread, so that concurrent requests
+    can be batched together.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, batcher, verbose=False):
+        """
+        :param address:
+            `host, port` to listen on.
+
+        :param batcher:
+            `Batcher` to submit images to.
+
+        :param verbose:
+            If true, log each request to stderr.
+
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.batcher = batcher
+        self.verbose = verbose
+
+
+def request_plates(url, data):
+    """
+    Send an encoded image to a detection server.
+
+    :param url:
+        Base URL of the server, for example `http://127.0.0.1:8080`.
+
+    :param data:
+        Encoded image, such as the contents of a JPEG file.
+
+    :returns:
+        List of plates, as returned by `Batcher.detect`.
+
+    """
+    request = urllib2.Request(url.rstrip("/") + "/detect", data,
+                              {"Content-Type": "application/octet-stream"})
+    return json.load(urllib2.urlopen(request))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Number plate detection "
+                                                 "server.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="Run a server.")
+    serve_parser.add_argument("weights", help="Weights file or store.")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--max-batch-size", type=int, default=16)
+    serve_parser.add_argument("--max-latency",
+                              type=float,
+                              default=0.05,
+                              help="Longest time in seconds to hold a request "
+                                   "while waiting for others to batch it "
+                                   "with.")
+    serve_parser.add_argument("--backend",
+                              choices=("tensorflow", "numpy"),
+                              default="tensorflow")
+    serve_parser.add_argument("--scale-ratio", type=float,
+                              default=1. / 2 ** 0.5)
+    serve_parser.add_argument("--verbose", action="store_true")
+
+    client_parser = subparsers.add_parser(
+                        "client",
+                        help="Send images to a server, and print the results.")
+    client_parser.add_argument("url", help="Base URL of the server.")
+    client_parser.add_argument("images", nargs="+", help="Images to send.")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        with detect.Detector(weightstore.load_weights(args.weights),
+                             scale_ratio=args.scale_ratio,
+                             backend=args.backend) as detector:
+            batcher = Batcher(detector,
+                              max_batch_size=args.max_batch_size,
+                              max_latency=args.max_latency)
+            server = DetectionServer((args.host, args.port), batcher,
+                                     verbose=args.verbose)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                batcher.close()
+    elif args.command == "client":
+        for fname in args.images:
+            with open(fname, "rb") as f:
+                plates = request_plates(args.url, f.read())
+            print "{}: {}".format(fname, json.dumps(plates))
@@ -0,0 +1,445 @@
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Detect number plates in video streams.
+
+Frames are processed by a pipeline of three threads connected by bounded
+queues: one decoding frames from a `cv2.VideoCapture`, one running the
+detector, and one annotating and encoding the output. The detector therefore
+does not wait for decoding or encoding, and memory use stays bounded.
+
+For fixed cameras `IncrementalDetector` avoids re-evaluating the parts of a
+frame which have not changed since they were last evaluated.
+
+"""
+
+
+__all__ = (
+    'BoxTracker',
+    'IncrementalDetector',
+    'StreamStats',
+    'open_capture',
+    'process_stream',
+)
+
+
+import Queue
+import sys
+import threading
+import time
+
+import cv2
+import numpy
+
+import detect
+
+
+# Marks the end of the stream on a queue.
+_END = object()
+
+
+class StreamStats(object):
+    """
+    Running counts of frames handled by `process_stream`.
+
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.frames_processed = 0
+
+    @property
+    def fps(self):
+        """
+        Frames processed per second since the stream started.
+
+        """
+        return self.frames_processed / max(time.time() - self.start_time, 1e-6)
+
+    def __str__(self):
+        return "read: {} processed: {} dropped: {} fps: {:.2f}".format(
+                    self.frames_read,
+                    self.frames_processed,
+                    self.frames_dropped,
+                    self.fps)
+
+
+def _normalize_bbox(bbox):
+    # Order the corners of a box so that the top-left precedes the
+    # bottom-right.
+    return numpy.concatenate([numpy.minimum(bbox[:2], bbox[2:]),
+                              numpy.maximum(bbox[:2], bbox[2:])])
+
+
+def _iou(a, b):
+    inter = (max(0, min(a[2], b[2]) - max(a[0], b[0])) *
+             max(0, min(a[3], b[3]) - max(a[1], b[1])))
+    union = ((a[2] - a[0]) * (a[3] - a[1]) +
+             (b[2] - b[0]) * (b[3] - b[1]) - inter)
+    return inter / union if union > 0 else 0.
+
+
+class BoxTracker(object):
+    """
+    Assign persistent identifiers to plates detected in consecutive frames.
+
+    Each plate is matched with the unmatched track from the previous frame
+    which it overlaps the most, provided the intersection over union is at
+    least `min_iou`. Plates which match no track start a new track, and tracks
+    which match no plate are dropped.
+
+    """
+
+    def __init__(self, min_iou=0.3):
+        self.min_iou = min_iou
+        self._next_id = 0
+        self._tracks = []
+
+    def update(self, matches):
+        """
+        Update the tracks with the plates detected in a new frame.
+
+        :param matches:
+            Sequence of matches, as returned by `detect.post_process`.
+
+        :returns:
+            List giving the track identifier of each match.
+
+        """
+        bboxes = [_normalize_bbox(numpy.concatenate([m[0], m[1]]))
+                  for m in matches]
+        unmatched = dict(self._tracks)
+        track_ids = []
+        for bbox in bboxes:
+            best_id, best_iou = None, self.min_iou
+            for track_id, track_bbox in unmatched.items():
+                iou = _iou(bbox, track_bbox)
+                if iou >= best_iou:
+                    best_id, best_iou = track_id, iou
+            if best_id is None:
+                best_id = self._next_id
+                self._next_id += 1
+            else:
+                del unmatched[best_id]
+            track_ids.append(best_id)
+
+        self._tracks = zip(track_ids, bboxes)
+        return track_ids
+
+
+class IncrementalDetector(object):
+    """
+    Detect number plates in consecutive frames from a fixed camera.
+
+    A reference frame is kept, holding for each pixel its value when it was
+    last evaluated. Pixels which differ from the reference by more than
+    `motion_threshold` form a motion mask, and only the windows whose
+    receptive fields touch the mask are evaluated again (see
+    `detect.Detector.find_matches_masked`). The matches from the other windows
+    are carried forward from the previous frame, before merging with
+    `post_process`.
+
+    """
+
+    def __init__(self, detector, motion_threshold=0.05, refresh_interval=250,
+                 strategy='intersect', iou_threshold=0.5):
+        """
+        :param detector:
+            `detect.Detector` to detect plates with.
+
+        :param motion_threshold:
+            Change in pixel value, on a 0 to 1 scale, above which a pixel is
+            considered to have changed.
+
+        :param refresh_interval:
+            (Optional.) Evaluate the whole of every `refresh_interval`th
+            frame, to bound the effect of gradual changes such as lighting.
+
+        :param strategy:
+            Grouping strategy passed to `post_process`.
+
+        :param iou_threshold:
+            Intersection over union threshold passed to `post_process`.
+
+        """
+        self.detector = detector
+        self.motion_threshold = motion_threshold
+        self.refresh_interval = refresh_interval
+        self.strategy = strategy
+        self.iou_threshold = iou_threshold
+        self.tracker = BoxTracker()
+        self.track_ids = []
+        self.motion_fraction = 1.
+
+        self._reference = None
+        self._matches = None
+        self._frames_since_refresh = 0
+
+    def _motion_mask(self, im):
+        diff = numpy.abs(im - self._reference) > self.motion_threshold
+        # Remove isolated changed pixels, which are most likely noise.
+        return cv2.morphologyEx(diff.astype(numpy.uint8),
+                                cv2.MORPH_OPEN,
+                                numpy.ones((3, 3), numpy.uint8))
+
+    def detect(self, im):
+        """
+        Detect number plates in the next frame of the stream.
+
+        :param im:
+            Grayscale frame, with values between 0 and 1.
+
+        :returns:
+            List of matches as returned by `detect.post_process`. The track
+            identifier of each match is left in `track_ids`.
+
+        """
+        refresh = (self._reference is None or
+                   self._reference.shape != im.shape or
+                   (self.refresh_interval is not None and
+                    self._frames_since_refresh >= self.refresh_interval))
+
+        if refresh:
+            matches = self.detector.find_matches([im])[0]
+            self._reference = im.copy()
+            self._frames_since_refresh = 0
+            self.motion_fraction = 1.
+        else:
+            mask = self._motion_mask(im)
+            self.motion_fraction = numpy.mean(mask)
+            matches = self._matches
+            if self.motion_fraction > 0:
+                # Keep the previous matches whose receptive fields lie
+                # entirely outside the mask, and evaluate the rest again.
+                touching = detect.boxes_touching_mask(
+                                detect.receptive_fields(matches.bboxes),
+                                cv2.integral(mask))
+                carried = detect.Matches(*(a[~touching] for a in matches))
+                matches = detect.concatenate_matches([
+                    carried,
+                    self.detector.find_matches_masked(im, mask,
+                                                      receptive=True)])
+                self._reference[mask != 0] = im[mask != 0]
+            self._frames_since_refresh += 1
+
+        self._matches = matches
+        plates = list(self.detector.post_process(matches,
+                                                 self.strategy,
+                                                 self.iou_threshold))
+        self.track_ids = self.tracker.update(plates)
+        return plates
+
+
+def open_capture(source):
+    """
+    Open a video file, or a capture device given by its number.
+
+    """
+    if isinstance(source, int) or source.isdigit():
+        source = int(source)
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError("Could not open video source {}".format(source))
+    return capture
+
+
+def _put_dropping_oldest(q, item):
+    # Add an item to a full queue by discarding the oldest item. Returns the
+    # number of items discarded.
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except Queue.Full:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except Queue.Empty:
+                pass
+
+
+def _put(q, item, stop):
+    # Block until the item is queued, or until asked to stop.
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+    return _END
+
+
+def process_stream(capture, detector, sink=None, real_time=False,
+                   queue_size=4, report_interval=None, incremental=False):
+    """
+    Detect number plates in each frame of a video stream.
+
+    :param capture:
+        `cv2.VideoCapture` to read frames from.
+
+    :param detector:
+        `detect.Detector` to detect plates with.
+
+    :param sink:
+        (Optional.) Callable which is passed each frame, annotated with the
+        detected plates, along with the plates detected in it.
+
+    :param real_time:
+        If true, frames are dropped rather than waiting for the detector to
+        catch up with the stream. The oldest waiting frame is dropped, so that
+        the output lags the stream as little as possible.
+
+    :param queue_size:
+        Maximum number of frames waiting between each stage.
+
+    :param report_interval:
+        (Optional.) If given, print statistics to stderr every
+        `report_interval` seconds.
+
+    :param incremental:
+        If true, wrap the detector in an `IncrementalDetector`, so that only
+        the parts of each frame which have changed are evaluated.
+
+    :returns:
+        A `StreamStats` for the stream.
+
+    """
+    stats = StreamStats()
+    stop = threading.Event()
+    frames = Queue.Queue(queue_size)
+    results = Queue.Queue(queue_size)
+    errors = []
+
+    def read():
+        while not stop.is_set():
+            ok, frame = capture.read()
+            if not ok:
+                break
+            stats.frames_read += 1
+            if real_time:
+                stats.frames_dropped += _put_dropping_oldest(frames, frame)
+            elif not _put(frames, frame, stop):
+                break
+        _put(frames, _END, stop)
+
+    if incremental:
+        incremental_detector = IncrementalDetector(detector)
+
+    def infer():
+        while True:
+            frame = _get(frames, stop)
+            if frame is _END:
+                break
+            with detector.profiler.stage("convert"):
+                im_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) / 255.
+            if incremental:
+                matches = incremental_detector.detect(im_gray)
+            else:
+                matches = list(detector.post_process(
+                                    detector.find_matches([im_gray])[0]))
+            if not _put(results, (frame, matches), stop):
+                break
+        _put(results, _END, stop)
+
+    def write():
+        while True:
+            item = _get(results, stop)
+            if item is _END:
+                break
+            frame, matches = item
+            detect.annotate(frame, matches)
+            if sink is not None:
+                sink(frame, matches)
+            stats.frames_processed += 1
+
+    def run(target):
+        try:
+            target()
+        except Exception:
+            errors.append(sys.exc_info())
+            stop.set()
+
+    threads = [threading.Thread(target=run, args=(target,))
+                   for target in (read, infer, write)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        last_report = time.time()
+        while threads[-1].is_alive():
+            threads[-1].join(0.1)
+            if (report_interval is not None and
+                time.time() - last_report >= report_interval):
+                print >>sys.stderr, stats
+                last_report = time.time()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+
+    return stats
+
+
+def main(source, detector, out_fname=None, real_time=False,
+         incremental=False):
+    capture = open_capture(source)
+
+    writer = [None]
+    def sink(frame, matches):
+        if out_fname is None:
+            return
+        if writer[0] is None:
+            fps = capture.get(cv2.cv.CV_CAP_PROP_FPS) or 25.
+            writer[0] = cv2.VideoWriter(out_fname,
+                                        cv2.cv.CV_FOURCC(*"MJPG"),
+                                        fps,
+                                        (frame.shape[1], frame.shape[0]))
+        writer[0].write(frame)
+
+    try:
+        stats = process_stream(capture, detector, sink,
+                               real_time=real_time,
+                               report_interval=5.0,
+                               incremental=incremental)
+    finally:
+        capture.release()
+        if writer[0] is not None:
+            writer[0].release()
+
+    print >>sys.stderr, stats
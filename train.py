@@ -28,16 +28,20 @@ Routines for training the network.
 
 
 __all__ = (
+    'ReadStats',
+    'read_batches',
     'train',
+    'train_presence',
 )
 
 
-import functools
+import argparse
 import glob
 import itertools
 import multiprocessing
+import Queue
 import random
-import sys
+import signal
 import time
 
 import cv2
@@ -47,6 +51,8 @@ import tensorflow as tf
 import common
 import gen
 import model
+import ringbuffer
+import weightstore
 
 
 def code_to_vec(p, code):
@@ -86,40 +92,133 @@ def batch(it, batch_size):
         yield out
 
 
-def mpgen(f):
-    def main(q, args, kwargs):
-        try:
-            for item in f(*args, **kwargs):
-                q.put(item)
-        finally:
-            q.close()
-
-    @functools.wraps(f)
-    def wrapped(*args, **kwargs):
-        q = multiprocessing.Queue(3) 
-        proc = multiprocessing.Process(target=main,
-                                       args=(q, args, kwargs))
-        proc.start()
-        try:
-            while True:
-                item = q.get()
-                yield item
-        finally:
-            proc.terminate()
-            proc.join()
+class ReadStats(object):
+    """
+    Running counts of batches delivered by `read_batches`.
 
-    return wrapped
-        
+    A batch is starved if no batch was ready when the trainer asked for one,
+    so that the trainer had to wait for the workers. If training is rarely
+    starved, adding workers will not speed it up.
 
-@mpgen
-def read_batches(batch_size):
-    g = gen.generate_ims()
-    def gen_vecs():
-        for im, c, p in itertools.islice(g, batch_size):
-            yield im, code_to_vec(p, c)
+    """
 
+    def __init__(self):
+        self.start_time = time.time()
+        self.batches = 0
+        self.starved_batches = 0
+        self.wait_time = 0.
+
+    def __str__(self):
+        return ("batches: {} starved: {} ({:.1f}%) waiting: {:.1f}s "
+                "({:.1f}% of time)").format(
+                    self.batches,
+                    self.starved_batches,
+                    100. * self.starved_batches / max(1, self.batches),
+                    self.wait_time,
+                    100. * self.wait_time /
+                        max(time.time() - self.start_time, 1e-6))
+
+
+def _generate_batches(ring, batch_size, seed):
+    # Runs in a worker process, writing batches into slots of `ring` forever.
+    # Keyboard interrupts are left to the trainer, which terminates the
+    # workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    random.seed(seed)
+    numpy.random.seed(seed)
+
+    g = gen.generate_ims()
     while True:
-        yield unzip(gen_vecs())
+        idx, (xs, ys) = ring.acquire()
+        for i, (im, c, p) in enumerate(itertools.islice(g, batch_size)):
+            xs[i] = im
+            ys[i] = code_to_vec(p, c)
+        ring.publish(idx)
+
+
+def read_batches(batch_size, workers=1, ordered=True, prefetch=3, seed=None,
+                 stats=None):
+    """
+    Generate training batches in worker processes.
+
+    The workers write batches directly into shared memory (see
+    `ringbuffer`), so batches are not copied between processes. The arrays
+    yielded are views of the shared memory, which are only valid until the
+    next batch is requested.
+
+    :param batch_size:
+        Number of images per batch.
+
+    :param workers:
+        Number of worker processes generating batches.
+
+    :param ordered:
+        If true, batches are taken from the workers in turn, so that with a
+        given seed the sequence of batches is reproducible. Otherwise each
+        batch is taken from whichever worker finishes first, so that a slow
+        worker does not hold up the others.
+
+    :param prefetch:
+        Number of batches which may be generated ahead of the trainer.
+
+    :param seed:
+        (Optional.) Worker `i` seeds `random` and `numpy.random` with
+        `seed + i`, so that workers generate different images. If not given,
+        a seed is picked at random.
+
+    :param stats:
+        (Optional.) `ReadStats` to update as batches are delivered.
+
+    :return:
+        Iterable of `xs, ys` pairs of float32 arrays, as returned by `unzip`.
+
+    """
+    if seed is None:
+        seed = random.SystemRandom().randint(0, 2 ** 31)
+    if stats is None:
+        stats = ReadStats()
+
+    # In order, each worker has its own slots, so that the trainer can wait
+    # for a particular worker. Otherwise the workers share slots. Either way
+    # there is an extra slot for the batch held by the trainer.
+    shapes = [(batch_size,) + gen.OUTPUT_SHAPE,
+              (batch_size, 1 + 7 * len(common.CHARS))]
+    if ordered:
+        rings = [ringbuffer.RingBuffer(max(1, -(-prefetch // workers)) + 1,
+                                       shapes)
+                     for i in range(workers)]
+    else:
+        rings = [ringbuffer.RingBuffer(prefetch + 1, shapes)] * workers
+    procs = [multiprocessing.Process(target=_generate_batches,
+                                     args=(ring, batch_size,
+                                           (seed + i) % 2 ** 32))
+                 for i, ring in enumerate(rings)]
+    for proc in procs:
+        proc.daemon = True
+        proc.start()
+
+    held = None
+    try:
+        for ring in itertools.cycle(rings):
+            # The trainer has finished with the previous batch, so its slot
+            # can be refilled.
+            if held is not None:
+                held[0].release(held[1])
+            try:
+                idx, arrays = ring.get(block=False)
+            except Queue.Empty:
+                start = time.time()
+                idx, arrays = ring.get()
+                stats.wait_time += time.time() - start
+                stats.starved_batches += 1
+            held = ring, idx
+            stats.batches += 1
+            yield arrays
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
 
 
 def get_loss(y, y_):
@@ -143,7 +242,8 @@ def get_loss(y, y_):
     return digits_loss, presence_loss, digits_loss + presence_loss
 
 
-def train(learn_rate, report_steps, batch_size, initial_weights=None):
+def train(learn_rate, report_steps, batch_size, initial_weights=None,
+          workers=1, ordered=True, prefetch=3, seed=None):
     """
     Train the network.
 
@@ -161,13 +261,23 @@ def train(learn_rate, report_steps, batch_size, initial_weights=None):
         The size of the batches used for training.
 
     :param initial_weights:
-        (Optional.) Weights to initialize the network with.
+        (Optional.) Weights to initialize the network with. If these are
+        factorized weights output by `factorize.py`, the factorized model is
+        trained, allowing it to be fine-tuned.
+
+    :param workers:
+        Number of processes generating training data. See `read_batches`, as
+        for `ordered`, `prefetch` and `seed`.
 
     :return:
         The learned network weights.
 
     """
-    x, y, params = model.get_training_model()
+    if initial_weights is not None:
+        x, y, params = model.get_training_model(
+                                        *common.fc_ranks(initial_weights))
+    else:
+        x, y, params = model.get_training_model()
 
     y_ = tf.placeholder(tf.float32, [None, 7 * len(common.CHARS) + 1])
 
@@ -234,7 +344,9 @@ def train(learn_rate, report_steps, batch_size, initial_weights=None):
         try:
             last_batch_idx = 0
             last_batch_time = time.time()
-            batch_iter = enumerate(read_batches(batch_size))
+            read_stats = ReadStats()
+            batch_iter = enumerate(read_batches(batch_size, workers, ordered,
+                                                prefetch, seed, read_stats))
             for batch_idx, (batch_xs, batch_ys) in batch_iter:
                 do_batch()
                 if batch_idx % report_steps == 0:
@@ -243,6 +355,7 @@ def train(learn_rate, report_steps, batch_size, initial_weights=None):
                         print "time for 60 batches {}".format(
                             60 * (last_batch_time - batch_time) /
                                             (last_batch_idx - batch_idx))
+                        print read_stats
                         last_batch_idx = batch_idx
                         last_batch_time = batch_time
 
@@ -252,16 +365,155 @@ def train(learn_rate, report_steps, batch_size, initial_weights=None):
             return last_weights
 
 
+def train_presence(learn_rate, report_steps, batch_size, initial_weights,
+                   initial_presence_weights=None, workers=1, ordered=True,
+                   prefetch=3, seed=None):
+    """
+    Train the presence model, for use with `detect.Detector`'s sparse mode.
+
+    The convolutional layers are shared with the full model, so they are
+    initialized from `initial_weights` and held fixed. Only the presence
+    model's own parameters are trained, against the presence indicator of the
+    training data.
+
+    As with `train`, training ceases upon `KeyboardInterrupt`, at which point
+    the learned presence model parameters are saved to
+    `presence_weights.npz`, and also returned.
+
+    :param learn_rate:
+        Learning rate to use.
+
+    :param report_steps:
+        Every `report_steps` batches a progress report is printed.
+
+    :param batch_size:
+        The size of the batches used for training.
+
+    :param initial_weights:
+        Weights of the full model, as output by `train`.
+
+    :param initial_presence_weights:
+        (Optional.) Presence model weights to initialize the presence model
+        with.
+
+    :param workers:
+        As for `train`, as are `ordered`, `prefetch` and `seed`.
+
+    :return:
+        The learned presence model weights.
+
+    """
+    x, y, conv_vars, presence_vars = model.get_presence_training_model()
+
+    y_ = tf.placeholder(tf.float32, [None, 7 * len(common.CHARS) + 1])
+
+    loss = tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(y,
+                                                                 y_[:, :1]))
+    train_step = tf.train.AdamOptimizer(learn_rate).minimize(
+                                                    loss, var_list=presence_vars)
+
+    init = tf.initialize_all_variables()
+    assign_ops = [w.assign(v) for w, v in
+                      zip(conv_vars, initial_weights[:len(conv_vars)])]
+    if initial_presence_weights is not None:
+        assert len(presence_vars) == len(initial_presence_weights)
+        assign_ops += [w.assign(v) for w, v in
+                           zip(presence_vars, initial_presence_weights)]
+
+    def do_report():
+        r = sess.run([tf.greater(y[:, 0], 0), y_[:, 0], loss],
+                     feed_dict={x: test_xs, y_: test_ys})
+        present = r[1] > 0.5
+        print ("B{:3d} {:2.02f}% recall: {:2.02f}% loss: {}").format(
+            batch_idx,
+            100. * numpy.sum(r[0] == present) / len(r[0]),
+            100. * numpy.sum(r[0] & present) / max(1, numpy.sum(present)),
+            r[2])
+        print read_stats
+
+    gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.95)
+    with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
+        sess.run(init)
+        sess.run(assign_ops)
+
+        test_xs, test_ys = unzip(list(read_data("test/*.png"))[:50])
+
+        try:
+            read_stats = ReadStats()
+            batch_iter = enumerate(read_batches(batch_size, workers, ordered,
+                                                prefetch, seed, read_stats))
+            for batch_idx, (batch_xs, batch_ys) in batch_iter:
+                sess.run(train_step, feed_dict={x: batch_xs, y_: batch_ys})
+                if batch_idx % report_steps == 0:
+                    do_report()
+
+        except KeyboardInterrupt:
+            last_weights = [p.eval() for p in presence_vars]
+            numpy.savez("presence_weights.npz", *last_weights)
+            return last_weights
+
+
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        f = numpy.load(sys.argv[1])
-        initial_weights = [f[n] for n in sorted(f.files,
-                                                key=lambda s: int(s[4:]))]
+    parser = argparse.ArgumentParser(description="Train the network.")
+    parser.add_argument("initial_weights",
+                        nargs="?",
+                        help="Weights to initialize the network with.")
+    parser.add_argument("--presence",
+                        metavar="PRESENCE_WEIGHTS",
+                        nargs="?",
+                        const=True,
+                        help="Train the presence model used by detect.py's "
+                             "--presence-weights, on top of the convolutional "
+                             "layers of initial_weights. Optionally give "
+                             "presence weights to initialize it with.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes generating training data.")
+    parser.add_argument("--unordered",
+                        action="store_true",
+                        help="Take each batch from whichever worker finishes "
+                             "first, rather than from each worker in turn. "
+                             "Faster, but not reproducible.")
+    parser.add_argument("--prefetch",
+                        type=int,
+                        default=3,
+                        help="Number of batches to generate ahead of "
+                             "training.")
+    parser.add_argument("--seed",
+                        type=int,
+                        help="Seed for training data generation. Worker i "
+                             "uses seed + i.")
+    args = parser.parse_args()
+
+    if args.initial_weights:
+        initial_weights = weightstore.load_weights(args.initial_weights)
     else:
         initial_weights = None
 
-    train(learn_rate=0.001,
-          report_steps=20,
-          batch_size=50,
-          initial_weights=initial_weights)
-
+    if args.presence:
+        if initial_weights is None:
+            parser.error("--presence requires initial weights")
+        if args.presence is True:
+            initial_presence_weights = None
+        else:
+            initial_presence_weights = weightstore.load_weights(
+                                                                args.presence)
+        train_presence(learn_rate=0.001,
+                       report_steps=20,
+                       batch_size=50,
+                       initial_weights=initial_weights,
+                       initial_presence_weights=initial_presence_weights,
+                       workers=args.workers,
+                       ordered=not args.unordered,
+                       prefetch=args.prefetch,
+                       seed=args.seed)
+    else:
+        train(learn_rate=0.001,
+              report_steps=20,
+              batch_size=50,
+              initial_weights=initial_weights,
+              workers=args.workers,
+              ordered=not args.unordered,
+              prefetch=args.prefetch,
+              seed=args.seed)
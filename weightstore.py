@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016 Matthew Earl
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+#     The above copyright notice and this permission notice shall be included
+#     in all copies or substantial portions of the Software.
+# 
+#     THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#     OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#     MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+#     NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+#     DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+#     OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+#     USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Uncompressed, memory-mappable storage for model weights.
+
+A weights store is a directory containing one `.npy` file per parameter, and a
+`manifest.json` giving the order, shape, dtype and SHA-1 checksum of each
+parameter. Loading a store memory-maps the `.npy` files rather than reading
+them, so processes which load the same store share a single copy of the
+weights in the page cache, and start up without reading weights they do not
+use.
+
+`load_weights` accepts either a store or a `.npz` file as written by
+`train.py`. Run this module as a script to convert between the two.
+
+"""
+
+
+__all__ = (
+    'is_store',
+    'load_weights',
+    'save_npz',
+    'save_store',
+    'verify_store',
+)
+
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy
+
+
+MANIFEST_NAME = "manifest.json"
+
+_VERSION = 1
+
+
+def _checksum(a):
+    return hashlib.sha1(numpy.ascontiguousarray(a).data).hexdigest()
+
+
+def is_store(fname):
+    """
+    Return whether `fname` is a weights store, as opposed to a `.npz` file.
+
+    """
+    return os.path.isfile(os.path.join(fname, MANIFEST_NAME))
+
+
+def save_store(dirname, param_vals):
+    """
+    Write model parameters to a weights store.
+
+    The manifest is written last, so an interrupted write does not leave
+    behind something which looks like a valid store.
+
+    :param dirname:
+        Directory to write the store to. It is created if it doesn't exist.
+
+    :param param_vals:
+        Sequence of parameter arrays, in model order.
+
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    manifest_fname = os.path.join(dirname, MANIFEST_NAME)
+    if os.path.exists(manifest_fname):
+        os.remove(manifest_fname)
+
+    entries = []
+    for idx, a in enumerate(param_vals):
+        a = numpy.asarray(a)
+        fname = "param_{}.npy".format(idx)
+        numpy.save(os.path.join(dirname, fname), a)
+        entries.append(dict(file=fname,
+                            shape=list(a.shape),
+                            dtype=a.dtype.str,
+                            sha1=_checksum(a)))
+
+    tmp_fname = manifest_fname + ".tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(dict(version=_VERSION, params=entries), f, indent=2)
+    os.rename(tmp_fname, manifest_fname)
+
+
+def _read_manifest(dirname):
+    with open(os.path.join(dirname, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != _VERSION:
+        raise ValueError("Unsupported weights store version {!r} in "
+                         "{}".format(manifest.get('version'), dirname))
+    return manifest['params']
+
+
+def _load_store(dirname, mmap_mode):
+    param_vals = []
+    for entry in _read_manifest(dirname):
+        a = numpy.load(os.path.join(dirname, entry['file']),
+                       mmap_mode=mmap_mode)
+        if (list(a.shape) != entry['shape'] or
+                a.dtype != numpy.dtype(str(entry['dtype']))):
+            raise ValueError("{} in {} has shape {} and dtype {}, but the "
+                             "manifest gives {} and {}".format(
+                                entry['file'], dirname, a.shape, a.dtype,
+                                tuple(entry['shape']), entry['dtype']))
+        param_vals.append(a)
+    return param_vals
+
+
+def verify_store(dirname):
+    """
+    Check the contents of a weights store against its manifest's checksums.
+
+    This reads every parameter in full, so is not done by `load_weights`.
+
+    :raises ValueError:
+        If a parameter does not match its checksum.
+
+    """
+    entries = _read_manifest(dirname)
+    for entry, a in zip(entries, _load_store(dirname, mmap_mode='r')):
+        if _checksum(a) != entry['sha1']:
+            raise ValueError("Checksum mismatch for {} in {}".format(
+                                                    entry['file'], dirname))
+
+
+def load_weights(fname, mmap_mode='r'):
+    """
+    Load model parameters.
+
+    :param fname:
+        Either a weights store, or a `.npz` file as written by `train.py`.
+
+    :param mmap_mode:
+        Mode with which to memory-map the parameters of a weights store. See
+        `numpy.load`. The default gives read-only arrays backed by the page
+        cache. Pass `None` to read the parameters into memory instead. This
+        has no effect for `.npz` files, which are always read into memory.
+
+    :return:
+        List of parameter arrays, in model order.
+
+    """
+    if is_store(fname):
+        return _load_store(fname, mmap_mode)
+
+    f = numpy.load(fname)
+    return [f[n] for n in sorted(f.files, key=lambda s: int(s[4:]))]
+
+
+def save_npz(fname, param_vals):
+    """
+    Write model parameters to a `.npz` file, in the form written by
+    `train.py`.
+
+    """
+    numpy.savez(fname, *param_vals)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                description="Convert between .npz weights files and weights "
+                            "stores.")
+    parser.add_argument("input",
+                        help="Weights to convert. If this is a .npz file it "
+                             "is converted to a store, and if it is a store "
+                             "it is converted to a .npz file.")
+    parser.add_argument("output", help="Where to write the converted weights.")
+    parser.add_argument("--verify",
+                        action="store_true",
+                        help="Verify the checksums of a store being converted "
+                             "to a .npz file.")
+    args = parser.parse_args()
+
+    if is_store(args.input):
+        if args.verify:
+            verify_store(args.input)
+        save_npz(args.output, load_weights(args.input))
+    else:
+        save_store(args.output, load_weights(args.input))